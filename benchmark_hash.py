@@ -0,0 +1,103 @@
+"""benchmark_hash.py - Vazão e memória do cálculo de hashes dos pedaços (add_file)
+
+Compara três modos para cada tamanho de arquivo:
+  legado     - lê o arquivo inteiro e usa split_into_pieces (como era o add_file)
+  streaming  - hash_pieces com um único processo, lendo em blocos
+  paralelo   - hash_pieces distribuindo faixas do arquivo entre processos
+
+Cada medição roda num subprocesso próprio para que o pico de memória (RSS)
+reportado seja só daquele modo. O arquivo é gerado logo antes das medições,
+então todas leem do cache de páginas do SO e comparam apenas CPU/memória.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+    return int(text)
+
+
+def peak_rss_mb():
+    """Pico de memória residente deste processo e dos filhos (MB)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return max(own, children) / scale
+
+
+def run_mode(mode, path, workers):
+    """Executa um modo e imprime o resultado em JSON (chamado no subprocesso)"""
+    from peer import Peer, hash_pieces
+
+    start = time.perf_counter()
+    if mode == 'legado':
+        with open(path, 'rb') as f:
+            content = f.read()
+        pieces = Peer.split_into_pieces(None, content)
+        count = len(pieces)
+    else:
+        count = len(hash_pieces(path, workers=1 if mode == 'streaming' else workers))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'seconds': elapsed, 'pieces': count, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def create_file(path, size):
+    chunk = os.urandom(4 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(chunk[:min(remaining, len(chunk))])
+            remaining -= len(chunk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100M,1G,5G', help='Tamanhos de arquivo separados por vírgula')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processos no modo paralelo')
+    parser.add_argument('--legacy-max', default='1G', help='Maior arquivo medido no modo legado (usa RAM = arquivo)')
+    parser.add_argument('--dir', default=None, help='Diretório para os arquivos temporários')
+    parser.add_argument('--run', nargs=2, metavar=('MODO', 'ARQUIVO'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_mode(args.run[0], args.run[1], args.workers)
+        return
+
+    legacy_max = parse_size(args.legacy_max)
+    print(f"{'tamanho':>8} {'modo':<10} {'MB/s':>9} {'tempo (s)':>10} {'pico RSS (MB)':>14}")
+    for size_text in args.sizes.split(','):
+        size = parse_size(size_text)
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            path = os.path.join(tmp, 'dados.bin')
+            create_file(path, size)
+            for mode in ('legado', 'streaming', 'paralelo'):
+                if mode == 'legado' and size > legacy_max:
+                    print(f"{size_text:>8} {mode:<10} {'(pulado: excede --legacy-max)':>35}")
+                    continue
+                output = subprocess.run(
+                    [sys.executable, __file__, '--workers', str(args.workers), '--run', mode, path],
+                    capture_output=True, text=True, check=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__))
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                rss = result['peak_rss_mb']
+                print(f"{size_text:>8} {mode:<10} {size / result['seconds'] / 1e6:>9.1f} "
+                      f"{result['seconds']:>10.2f} {rss if rss is None else round(rss):>14}")
+
+
+if __name__ == "__main__":
+    main()
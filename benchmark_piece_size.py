@@ -0,0 +1,92 @@
+"""benchmark_piece_size.py - Vazão de download para diferentes tamanhos de pedaço
+
+Sobe um ou mais seeders e um downloader no mesmo processo (portas locais
+aleatórias, sem tracker) e baixa o mesmo arquivo com cada tamanho de pedaço,
+reportando vazão, número de pedaços e o tamanho dos metadados (file_info).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from metricas import configure_logging
+from peer import MetainfoStore, Peer, choose_piece_size
+
+SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+    return int(text)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_peer(name, port):
+    peer = Peer(name, port=port)
+    peer.tracker_port = free_port()  # nenhum tracker escutando: o benchmark não depende dele
+    peer.peer_refresh_interval = 3600
+    threading.Thread(target=peer.start, daemon=True).start()
+    return peer
+
+
+def run(path, piece_size, seeders):
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        peers = []
+        torrent_hash = None
+        for i in range(seeders):
+            seeder = start_peer(f"bench_seeder_{i}", free_port())
+            seeder.piece_size = piece_size
+            time.sleep(0.1)
+            torrent_hash = seeder.add_file(path)
+            peers.append({'peer_id': seeder.peer_id, 'host': seeder.host, 'port': seeder.port})
+        file_info = seeder.get_file_info(torrent_hash)
+        downloader = start_peer('bench_downloader', free_port())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            ok = downloader.download_from_peers(torrent_hash, peers, os.path.join(tmp, 'saida.bin'))
+            elapsed = time.perf_counter() - start
+    return ok, elapsed, len(file_info['pieces']), len(json.dumps(file_info))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='64M', help='Tamanho do arquivo transferido')
+    parser.add_argument('--piece-sizes', default='1K,16K,64K,256K,1M,4M',
+                        help='Tamanhos de pedaço separados por vírgula')
+    parser.add_argument('--seeders', type=int, default=2, help='Seeders servindo o arquivo')
+    args = parser.parse_args()
+    # Os peers do benchmark rodam sem tracker: os avisos de conexão recusada (em stderr) só poluem a tabela
+    configure_logging('ERROR')
+
+    size = parse_size(args.size)
+    print(f"Arquivo de {args.size}; tamanho automático escolhido: {choose_piece_size(size) // 1024} KiB\n")
+    print(f"{'pedaço':>8} {'pedaços':>9} {'file_info':>12} {'tempo (s)':>10} {'MB/s':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'dados.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        for text in args.piece_sizes.split(','):
+            # Cada rodada recalcula os hashes com o novo tamanho de pedaço
+            if os.path.exists(path + MetainfoStore.SUFFIX):
+                os.remove(path + MetainfoStore.SUFFIX)
+            ok, elapsed, pieces, info_bytes = run(path, parse_size(text), args.seeders)
+            status = f"{size / elapsed / 1e6:>9.1f}" if ok else '    falhou'
+            print(f"{text:>8} {pieces:>9} {info_bytes:>12,} {elapsed:>10.2f} {status}")
+
+
+if __name__ == "__main__":
+    main()
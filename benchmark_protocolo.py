@@ -0,0 +1,76 @@
+"""benchmark_protocolo.py - Compara o protocolo JSON legado com os quadros binários"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from protocolo import pack_frame, recv_frame, send_frame
+
+
+def legacy_roundtrip(pieces):
+    """Codifica e decodifica pedaços como no protocolo antigo (JSON + latin-1).
+
+    Feito em memória: sem enquadramento não há como enviar várias respostas
+    pelo mesmo socket, então o custo de syscalls fica só do lado binário.
+    """
+    wire_bytes = 0
+    for piece in pieces:
+        message = json.dumps({'status': 'success', 'piece_data': piece.decode('latin-1')}).encode('utf-8')
+        wire_bytes += len(message)
+        decoded = json.loads(message.decode('utf-8'))['piece_data'].encode('latin-1')
+        assert len(decoded) == len(piece)
+    return wire_bytes
+
+
+def framed_roundtrip(pieces):
+    """Envia os pedaços como quadros binários através de um socketpair real"""
+    left, right = socket.socketpair()
+    wire_bytes = [0]
+
+    def reader():
+        for _ in pieces:
+            header, body = recv_frame(right)
+            assert body
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for index, piece in enumerate(pieces):
+        header = {'status': 'success', 'piece_index': index}
+        wire_bytes[0] += len(pack_frame(header, len(piece))) + len(piece)
+        send_frame(left, header, piece)
+    thread.join()
+    left.close()
+    right.close()
+    return wire_bytes[0]
+
+
+def measure(label, func, pieces, total_mb):
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    wire_bytes = func(pieces)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    print(f"{label:<22} bytes no fio: {wire_bytes:>12,}  "
+          f"({wire_bytes / (total_mb * 1024 * 1024):.2f}x)  "
+          f"CPU/MB: {cpu / total_mb * 1000:7.2f} ms  "
+          f"vazão: {total_mb / elapsed:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mb', type=int, default=16, help='Volume de dados transferido (MB)')
+    parser.add_argument('--piece-size', type=int, default=1024, help='Tamanho do pedaço em bytes')
+    args = parser.parse_args()
+
+    data = os.urandom(args.mb * 1024 * 1024)
+    pieces = [data[i:i + args.piece_size] for i in range(0, len(data), args.piece_size)]
+    print(f"{args.mb} MB em {len(pieces)} pedaços de {args.piece_size} bytes\n")
+
+    measure('JSON + latin-1', legacy_roundtrip, pieces, args.mb)
+    measure('Quadro binário', framed_roundtrip, pieces, args.mb)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""benchmark_swarm.py - Enxame local completo: tracker, N seeders e M leechers
+
+Gera um arquivo aleatório do tamanho pedido, sobe um tracker e os peers em
+portas efêmeras e dispara os downloads dos leechers ao mesmo tempo (ou
+espaçados por --stagger). Leechers também servem os pedaços que já têm, como
+num enxame real, e continuam no ar até o último terminar.
+
+Com --mode processes cada peer roda no seu processo (e o tracker num
+subprocesso), o que permite medir CPU e pico de RSS por peer; com --mode
+threads tudo roda neste processo e só os totais do processo são medidos.
+Reporta vazão agregada e por leecher, percentis do tempo até completar,
+pedidos por segundo atendidos pelo tracker (da ação `stats`), CPU e RSS.
+Com --json o resultado completo vai para um arquivo (ou `-` para a saída
+padrão), para comparar versões e pegar regressões.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmark_piece_size import parse_size
+from benchmark_tracker import free_port, percentile, start_tracker, tracker_cpu, tracker_request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRACKER_ACTIONS = ('announce', 'announce_batch', 'get_peers', 'register_torrent', 'list_torrents')
+
+
+def peak_rss_mb():
+    """Pico de memória residente deste processo (None onde não há `resource`)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KiB, macOS em bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def process_peak_rss_mb(pid):
+    """Pico de RSS de outro processo, lido de /proc (None fora do Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f"Nada escutando na porta {port}")
+
+
+def run_peer(role, name, tracker_port, path, piece_size, cache_size, control, own_process):
+    """Vida de um peer do enxame, comandada pela ponta `control` de um Pipe.
+
+    Seeder: compartilha `path` e informa o info-hash. Leecher: espera o hash,
+    baixa para `path` e informa o tempo. Os dois seguem servindo até receber
+    `stop` e então enviam o relatório de tráfego (e de CPU/RSS, se o peer tem
+    o processo só para si).
+    """
+    from peer import Peer
+    if own_process:
+        sys.stdout = open(os.devnull, 'w')  # a lista de torrents do construtor não interessa aqui
+    peer = Peer(name, port=free_port(), tracker_port=tracker_port)
+    peer.piece_size = piece_size
+    if cache_size is not None:
+        peer.piece_cache.budget = cache_size
+    threading.Thread(target=peer.start, daemon=True).start()
+    wait_listening(peer.port)
+
+    if role == 'seeder':
+        control.send({'torrent_hash': peer.add_file(path)})
+    else:
+        control.send({'ready': True})
+        torrent_hash = control.recv()
+        start = time.perf_counter()
+        ok = peer.download_file(torrent_hash, path)
+        control.send({'ok': ok, 'seconds': time.perf_counter() - start})
+
+    control.recv()  # stop
+    metrics = peer.metrics
+    control.send({
+        'name': name,
+        'role': role,
+        'upload_mb': metrics.value('upload_bytes') / 1e6,
+        'download_mb': metrics.value('download_bytes') / 1e6,
+        'hash_failures': metrics.value('hash_failures'),
+        # Pedaços servidos: acertos saíram da memória, faltas foram lidas do disco
+        'cache_hits': peer.piece_cache.stats()['hits'],
+        'disk_reads': peer.piece_cache.stats()['misses'],
+        'pex_peers': metrics.value('pex_peers_received'),  # peers conhecidos por PEX, sem o tracker
+        'cpu_seconds': time.process_time() if own_process else None,
+        'peak_rss_mb': peak_rss_mb() if own_process else None,
+    })
+
+
+def start_swarm_peer(mode, role, name, tracker_port, path, piece_size, cache_size):
+    """Sobe um peer em thread ou processo próprio e retorna (ponta de controle, processo ou None)"""
+    if mode == 'processes':
+        # Não é daemon porque o seeder calcula os hashes com um pool de processos. Com fork o
+        # filho herda só o interpretador e os módulos já importados (o arquivo não fica em memória)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+        control, child = context.Pipe()
+        worker = context.Process(target=run_peer,
+                                 args=(role, name, tracker_port, path, piece_size, cache_size, child, True))
+        worker.start()
+        return control, worker
+    control, child = multiprocessing.Pipe()
+    threading.Thread(target=run_peer, daemon=True,
+                     args=(role, name, tracker_port, path, piece_size, cache_size, child, False)).start()
+    return control, None
+
+
+def receive(control, timeout, what):
+    try:
+        if control.poll(timeout):
+            return control.recv()
+    except EOFError:
+        raise RuntimeError(f"O peer terminou antes de enviar {what}")
+    raise RuntimeError(f"Tempo esgotado esperando {what}")
+
+
+def start_swarm_tracker(mode, tracker_mode, port):
+    """Tracker em subprocesso (modo processes) ou numa thread deste processo; retorna o Popen ou None"""
+    if mode == 'processes':
+        return start_tracker(port, tracker_mode, 1024, 1)
+    from tracker import Tracker
+    tracker = Tracker(port=port)
+    target = tracker.start_async if tracker_mode == 'async' else tracker.start
+    threading.Thread(target=target, daemon=True).start()
+    wait_listening(port)
+    return None
+
+
+def tracker_request_counts(port):
+    """Pedidos atendidos pelo tracker até agora, por ação (contagem dos histogramas de latência)"""
+    histograms = tracker_request(port, {'action': 'stats'})['metrics']['histograms']
+    return {action: histograms.get(f'request_seconds{{action="{action}"}}', {}).get('count', 0)
+            for action in TRACKER_ACTIONS}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_swarm(args):
+    size = parse_size(args.size)
+    piece_size = parse_size(args.piece_size) if args.piece_size else None
+    cache_size = parse_size(args.cache) if args.cache else None
+    port = free_port()
+    tracker = start_swarm_tracker(args.mode, args.tracker_mode, port)
+    tracker_rss = None
+    controls = []
+    workers = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'dados.bin')
+            with open(source, 'wb') as f:
+                for offset in range(0, size, 1024 * 1024):
+                    f.write(os.urandom(min(1024 * 1024, size - offset)))
+
+            # O primeiro seeder calcula os hashes; os outros reaproveitam o .meta.json
+            seeders = []
+            torrent_hash = None
+            for i in range(args.seeders):
+                control, worker = start_swarm_peer(args.mode, 'seeder', f"seeder_{i}", port, source,
+                                                   piece_size, cache_size)
+                controls.append(control)
+                workers.append(worker)
+                torrent_hash = receive(control, args.timeout, f"o info-hash do seeder {i}")['torrent_hash']
+                seeders.append(control)
+            leechers = []
+            for i in range(args.leechers):
+                control, worker = start_swarm_peer(args.mode, 'leecher', f"leecher_{i}", port,
+                                                   os.path.join(tmp, f"leecher_{i}.bin"), piece_size, cache_size)
+                controls.append(control)
+                workers.append(worker)
+                leechers.append(control)
+            for i, control in enumerate(leechers):
+                receive(control, args.timeout, f"o aviso de pronto do leecher {i}")
+
+            requests_before = tracker_request_counts(port)
+            cpu_before = tracker_cpu(tracker.pid) if tracker else None
+            start = time.perf_counter()
+            for control in leechers:
+                control.send(torrent_hash)
+                time.sleep(args.stagger)
+            deadline = time.time() + args.timeout
+            results = [receive(control, max(0, deadline - time.time()), f"o download do leecher {i}")
+                       for i, control in enumerate(leechers)]
+            wall = time.perf_counter() - start
+            requests = {action: count - requests_before[action]
+                        for action, count in tracker_request_counts(port).items()}
+            tracker_cpu_seconds = tracker_cpu(tracker.pid) - cpu_before if tracker else None
+
+            for control in controls:
+                control.send('stop')
+            reports = [receive(control, args.timeout, 'o relatório do peer') for control in controls]
+    finally:
+        for control in controls:
+            control.close()
+        for worker in workers:
+            if worker is not None:
+                worker.join(5)
+                if worker.is_alive():
+                    worker.terminate()
+        if tracker:
+            tracker_rss = process_peak_rss_mb(tracker.pid)
+            tracker.kill()
+            tracker.wait()
+
+    times = sorted(result['seconds'] for result in results if result['ok'])
+    completed = len(times)
+    for report, result in zip(reports[args.seeders:], results):
+        report['seconds'] = result['seconds'] if result['ok'] else None
+    return {
+        'version': git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'config': {'mode': args.mode, 'tracker_mode': args.tracker_mode, 'size': size,
+                   'piece_size': piece_size, 'cache': cache_size, 'seeders': args.seeders, 'leechers': args.leechers,
+                   'stagger': args.stagger},
+        'wall_seconds': wall,
+        'completed': completed,
+        'failed': args.leechers - completed,
+        # Vazão agregada: tudo o que os leechers baixaram dividido pelo tempo até o último terminar
+        'throughput_mb_s': completed * size / 1e6 / wall,
+        'leecher_mb_s': {'p50': size / 1e6 / percentile(times, 0.5) if times else None,
+                         'min': size / 1e6 / times[-1] if times else None},
+        'time_to_complete': {'p50': percentile(times, 0.5), 'p90': percentile(times, 0.9),
+                             'p99': percentile(times, 0.99), 'max': times[-1]} if times else
+                            dict.fromkeys(('p50', 'p90', 'p99', 'max')),
+        'tracker': {
+            'requests': requests,
+            'announces_per_second': (requests['announce'] + requests['announce_batch']) / wall,
+            'requests_per_second': sum(requests.values()) / wall,
+            'cpu_seconds': tracker_cpu_seconds,
+            'peak_rss_mb': tracker_rss,
+        },
+        # No modo threads CPU e RSS só existem para o processo inteiro
+        'process': {'cpu_seconds': time.process_time(), 'peak_rss_mb': peak_rss_mb()},
+        'peers': reports,
+    }
+
+
+def show(value, digits=2):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+def print_report(result):
+    config = result['config']
+    print(f"{config['seeders']} seeders, {config['leechers']} leechers, arquivo de {config['size']:,} bytes "
+          f"({config['mode']}, tracker {config['tracker_mode']})\n")
+    ttc = result['time_to_complete']
+    print(f"Completos: {result['completed']}/{config['leechers']} em {result['wall_seconds']:.2f}s  "
+          f"vazão agregada: {result['throughput_mb_s']:.1f} MB/s")
+    print(f"Tempo até completar (s): p50 {show(ttc['p50'])}  p90 {show(ttc['p90'])}  "
+          f"p99 {show(ttc['p99'])}  máx {show(ttc['max'])}")
+    tracker = result['tracker']
+    print(f"Tracker: {tracker['announces_per_second']:.1f} anúncios/s, "
+          f"{tracker['requests_per_second']:.1f} pedidos/s {tracker['requests']}")
+    if tracker['cpu_seconds'] is not None:
+        print(f"         CPU {tracker['cpu_seconds']:.2f}s, pico de RSS {show(tracker['peak_rss_mb'], 1)} MB")
+
+    print(f"\n{'peer':<12} {'tempo (s)':>10} {'MB enviados':>12} {'MB recebidos':>13} "
+          f"{'leituras':>9} {'do cache':>9} {'via PEX':>8} {'CPU (s)':>8} {'RSS (MB)':>9}")
+    for peer in result['peers']:
+        print(f"{peer['name']:<12} {show(peer.get('seconds')):>10} {peer['upload_mb']:>12.1f} "
+              f"{peer['download_mb']:>13.1f} {peer['disk_reads']:>9} {peer['cache_hits']:>9} {peer['pex_peers']:>8} "
+              f"{show(peer['cpu_seconds']):>8} {show(peer['peak_rss_mb'], 1):>9}")
+    process = result['process']
+    print(f"\nEste processo: CPU {process['cpu_seconds']:.2f}s, pico de RSS {show(process['peak_rss_mb'], 1)} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='16M', help='Tamanho do arquivo compartilhado')
+    parser.add_argument('--piece-size', default=None, help='Tamanho do pedaço (padrão: automático)')
+    parser.add_argument('--seeders', type=int, default=1, help='Peers que começam com o arquivo completo')
+    parser.add_argument('--leechers', type=int, default=4, help='Peers que baixam o arquivo')
+    parser.add_argument('--stagger', type=float, default=0, help='Intervalo (s) entre o início de cada leecher')
+    parser.add_argument('--cache', default=None,
+                        help='Orçamento do cache de pedaços de cada peer (ex.: 64M; 0 desliga; padrão do peer)')
+    parser.add_argument('--mode', choices=('processes', 'threads'), default='processes',
+                        help='Um processo por peer (mede CPU/RSS de cada um) ou tudo neste processo')
+    parser.add_argument('--tracker-mode', choices=('threads', 'async'), default='threads',
+                        help='Modo de servidor do tracker')
+    parser.add_argument('--timeout', type=float, default=300, help='Tempo máximo de cada etapa (s)')
+    parser.add_argument('--json', default=None, help='Grava o resultado em JSON neste arquivo (`-` = saída padrão)')
+    args = parser.parse_args()
+
+    if args.mode == 'threads':
+        # O construtor do Peer lista os torrents do tracker: silencia isso no modo com threads
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            result = run_swarm(args)
+    else:
+        result = run_swarm(args)
+    if args.json == '-':
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""benchmark_tracker.py - Gerador de carga para o tracker (threads x assíncrono x shards)
+
+Sobe o tracker num subprocesso em cada modo, registra um torrent com um enxame
+inicial e dispara pedidos `announce`/`get_peers` a partir de vários processos
+clientes, cada um com muitas conexões simultâneas (uma conexão por pedido, como
+os peers fazem). Reporta pedidos/s, latência p50/p99, bytes por resposta e erros.
+Com --compact os pedidos vão em quadros binários e as listas de peers voltam
+como registros compactos. O modo `sharded` sobe --workers processos na mesma
+porta; a carga se espalha por --torrents torrents para ocupar todos os shards.
+Com --udp cada cliente faz um connect UDP e manda os pedidos em datagramas, sem
+conexão TCP. A coluna ped/CPU-s divide os pedidos atendidos pelo tempo de CPU
+gasto pelos processos do tracker (pedidos por segundo de um núcleo).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from protocolo import (UDP_ANNOUNCE, UDP_CONNECT, UDP_GET_PEERS, UDP_PROTOCOL_ID, pack_frame, pack_udp_request, unpack_frame, unpack_peers,
+                       unpack_udp_response)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def torrent_hash(index):
+    return f"{index:040x}"
+
+
+def raise_fd_limit():
+    """Milhares de conexões simultâneas passam do limite padrão de descritores"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def tracker_request(port, request):
+    with socket.create_connection(('localhost', port), timeout=5) as sock:
+        sock.sendall(json.dumps(request).encode('utf-8'))
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return json.loads(data)
+            data += chunk
+
+
+def start_tracker(port, mode, backlog, workers):
+    command = [sys.executable, os.path.join(HERE, 'tracker.py'), '--port', str(port), '--backlog', str(backlog)]
+    if mode == 'async':
+        command.append('--async')
+    elif mode == 'sharded':
+        command += ['--workers', str(workers)]
+    process = subprocess.Popen(command, cwd=HERE, stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Tracker ({mode}) não subiu na porta {port}")
+
+
+def tracker_cpu(pid):
+    """Segundos de CPU do tracker e dos seus processos filhos (lidos de /proc; NaN fora do Linux)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except (OSError, ValueError, IndexError):
+        return float('nan')
+    return total + sum(tracker_cpu(int(child)) for child in children)
+
+
+def make_request(worker, sequence, numwant, torrents):
+    info_hash = torrent_hash(sequence // 2 % torrents)
+    if sequence % 2:
+        return {'action': 'get_peers', 'torrent_hash': info_hash, 'numwant': numwant}
+    return {'action': 'announce', 'peer_id': f"load_{worker}_{sequence % 25}", 'torrent_hash': info_hash,
+            'host': '10.0.0.1', 'port': 6881, 'is_seeder': False, 'numwant': numwant}
+
+
+async def client_loop(port, worker, total, concurrency, timeout, numwant, compact, torrents, udp):
+    loop = asyncio.get_running_loop()
+    latencies = []
+    errors = [0]
+    received = [0]
+    counter = iter(range(total))
+
+    async def exchange(sock, payload):
+        await loop.sock_connect(sock, ('127.0.0.1', port))
+        await loop.sock_sendall(sock, payload)
+        data = b''
+        while True:
+            chunk = await loop.sock_recv(sock, 65536)
+            if not chunk:  # cliente JSON: o tracker fecha a conexão após responder
+                return data
+            data += chunk
+            if compact and unpack_frame(data) is not None:
+                return data
+
+    def parse(data):
+        if not compact:
+            return json.loads(data)
+        response, body, _ = unpack_frame(data)
+        response['peers'] = unpack_peers(body, response['peers4'], response['peers6'])
+        return response
+
+    async def udp_exchange(sock, payload, transaction_id):
+        await loop.sock_sendall(sock, payload)
+        while True:
+            datagram = await loop.sock_recv(sock, 65536)
+            reply = unpack_udp_response(datagram)
+            if reply[1] == transaction_id:  # descarta respostas atrasadas de pedidos que já expiraram
+                return reply, len(datagram)
+    
+    async def one_udp_client():
+        # Um socket por "cliente": connect uma vez e depois só datagramas de pedido
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, ('127.0.0.1', port))
+            (_, _, connection_id), _ = await asyncio.wait_for(
+                udp_exchange(sock, pack_udp_request(UDP_PROTOCOL_ID, UDP_CONNECT, 0), 0), timeout)
+        except (OSError, asyncio.TimeoutError):
+            errors[0] += 1
+            sock.close()
+            return
+        for sequence in counter:
+            request = make_request(worker, sequence, numwant, torrents)
+            action = UDP_ANNOUNCE if request.pop('action') == 'announce' else UDP_GET_PEERS
+            payload = pack_udp_request(connection_id, action, sequence + 1, request)
+            start = time.perf_counter()
+            try:
+                (reply_action, _, (response, body)), size = await asyncio.wait_for(
+                    udp_exchange(sock, payload, sequence + 1), timeout)
+                if reply_action != action:
+                    raise ValueError('resposta com erro')
+                unpack_peers(body, response['peers4'], response['peers6'])
+                latencies.append(time.perf_counter() - start)
+                received[0] += size
+            except (OSError, ValueError, asyncio.TimeoutError):
+                errors[0] += 1  # sem retransmissão: uma perda conta como erro
+        sock.close()
+    
+    async def one_connection():
+        for sequence in counter:
+            request = make_request(worker, sequence, numwant, torrents)
+            if compact:
+                payload = pack_frame(dict(request, compact=True))
+            else:
+                payload = json.dumps(request).encode('utf-8')
+            start = time.perf_counter()
+            sock = socket.socket()
+            sock.setblocking(False)
+            try:
+                data = await asyncio.wait_for(exchange(sock, payload), timeout)
+                if parse(data).get('status') != 'success':
+                    raise ValueError('resposta com erro')
+                latencies.append(time.perf_counter() - start)
+                received[0] += len(data)
+            except (OSError, ValueError, asyncio.TimeoutError):
+                errors[0] += 1
+            finally:
+                sock.close()
+
+    await asyncio.gather(*((one_udp_client if udp else one_connection)() for _ in range(concurrency)))
+    return latencies, errors[0], received[0]
+
+
+def run_client(args):
+    raise_fd_limit()
+    start = time.time()
+    latencies, errors, received = asyncio.run(client_loop(*args))
+    return start, time.time(), latencies, errors, received
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_mode(mode, args):
+    port = free_port()
+    tracker = start_tracker(port, mode, args.backlog, args.workers)
+    try:
+        for index in range(args.torrents):
+            tracker_request(port, {'action': 'register_torrent', 'torrent_hash': torrent_hash(index),
+                                   'file_info': {'name': f"carga_{index}.bin", 'size': 0}})
+            for i in range(args.swarm):
+                tracker_request(port, {'action': 'announce', 'peer_id': f"seed_{i}",
+                                       'torrent_hash': torrent_hash(index),
+                                       'host': '10.0.0.2', 'port': 6881, 'is_seeder': True})
+
+        per_proc = args.requests // args.procs
+        jobs = [(port, w, per_proc, max(1, args.concurrency // args.procs), args.timeout,
+                 args.numwant, args.compact, args.torrents, args.udp) for w in range(args.procs)]
+        with multiprocessing.Pool(args.procs) as pool:
+            cpu_before = tracker_cpu(tracker.pid)
+            results = pool.map(run_client, jobs)
+            cpu = tracker_cpu(tracker.pid) - cpu_before
+    finally:
+        tracker.kill()
+        tracker.wait()
+
+    wall = max(result[1] for result in results) - min(result[0] for result in results)
+    latencies = sorted(latency for result in results for latency in result[2])
+    errors = sum(result[3] for result in results)
+    received = sum(result[4] for result in results)
+    print(f"{mode:<8} {len(latencies) / wall:>10.0f} {len(latencies) / cpu:>11.0f} "
+          f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} "
+          f"{received / max(1, len(latencies)):>11.0f} {errors:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000, help='Total de pedidos por modo')
+    parser.add_argument('--concurrency', type=int, default=1000, help='Conexões simultâneas (somando os processos)')
+    parser.add_argument('--procs', type=int, default=4, help='Processos geradores de carga')
+    parser.add_argument('--backlog', type=int, default=1024, help='Backlog do listen() do tracker')
+    parser.add_argument('--swarm', type=int, default=50, help='Peers já anunciados em cada torrent antes da carga')
+    parser.add_argument('--torrents', type=int, default=16, help='Torrents entre os quais a carga se divide')
+    parser.add_argument('--timeout', type=float, default=10, help='Tempo máximo por pedido (s)')
+    parser.add_argument('--modes', default='threads,async,sharded', help='Modos do tracker a comparar')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processos do modo sharded')
+    parser.add_argument('--numwant', type=int, default=50, help='Peers pedidos em cada resposta')
+    parser.add_argument('--compact', action='store_true', help='Usa quadros binários e listas compactas de peers')
+    parser.add_argument('--udp', action='store_true', help='Manda os pedidos em datagramas UDP (sempre compactos)')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{args.requests} pedidos, {args.concurrency} conexões simultâneas, backlog {args.backlog}, "
+          f"numwant {args.numwant}{', compacto' if args.compact else ''}{', UDP' if args.udp else ''}\n")
+    print(f"{'modo':<8} {'pedidos/s':>10} {'ped/CPU-s':>11} {'p50 (ms)':>9} {'p99 (ms)':>9} "
+          f"{'bytes/resp':>11} {'erros':>7}")
+    for mode in args.modes.split(','):
+        run_mode(mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# metricas.py - Métricas de desempenho e configuração de logs do tracker e dos peers
+import bisect
+import logging
+import threading
+import time
+
+# Limites (em segundos) dos baldes dos histogramas de latência
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATE_WINDOW = 10  # segundos considerados nas taxas (ex.: pedaços/s)
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def configure_logging(level='INFO'):
+    """Logs em stderr, uma linha por evento. Mensagens de caminho quente ficam em DEBUG"""
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format=LOG_FORMAT)
+
+
+class Histogram:
+    """Contagem de observações por balde (limites fixos), mais soma e total"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # o último balde é o +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """Limite superior do balde onde cai o quantil (estimativa conservadora)"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class RateMeter:
+    """Eventos por segundo na janela de RATE_WINDOW segundos (um balde por segundo)"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.slots = [0] * window
+        self.seconds = [0] * window  # segundo a que cada balde se refere
+
+    def add(self, amount=1):
+        second = int(time.monotonic())
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.slots[slot] = 0
+        self.slots[slot] += amount
+
+    def per_second(self):
+        now = int(time.monotonic())
+        return sum(amount for amount, second in zip(self.slots, self.seconds)
+                   if now - self.window < second <= now) / self.window
+
+
+class Metrics:
+    """Contadores, histogramas, taxas e medidores de um processo.
+
+    Contadores e histogramas aceitam rótulos (`action='announce'`); os medidores
+    são funções chamadas só na hora da leitura, então não custam nada no caminho
+    quente. `snapshot()` alimenta a ação `stats` e `exposition()` gera o formato
+    de texto do Prometheus (`# TYPE`, `nome{rótulo="valor"} número`).
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.started = time.time()
+        self.counters = {}    # (nome, rótulos) -> valor
+        self.histograms = {}  # (nome, rótulos) -> Histogram
+        self.rates = {}       # nome -> RateMeter
+        self.gauges = {}      # nome -> função sem argumentos
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def mark(self, name, amount=1):
+        """Soma ao contador `name` e à taxa `name` por segundo"""
+        with self.lock:
+            key = (name, ())
+            self.counters[key] = self.counters.get(key, 0) + amount
+            meter = self.rates.get(name)
+            if meter is None:
+                meter = self.rates[name] = RateMeter()
+            meter.add(amount)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def value(self, name, **labels):
+        """Valor atual de um contador"""
+        return self.counters.get((name, _label_key(labels)), 0)
+
+    def _gauge_values(self):
+        values = {'uptime_seconds': time.time() - self.started, 'threads': threading.active_count()}
+        for name, function in self.gauges.items():
+            try:
+                values[name] = function()
+            except Exception:
+                values[name] = None  # medidor que falhou não derruba a leitura dos demais
+        return values
+
+    def snapshot(self):
+        """Todas as métricas num dicionário serializável em JSON"""
+        gauges = self._gauge_values()
+        with self.lock:
+            counters = {_series(name, labels): value for (name, labels), value in self.counters.items()}
+            rates = {f"{name}_per_second": meter.per_second() for name, meter in self.rates.items()}
+            histograms = {_series(name, labels): {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99),
+            } for (name, labels), histogram in self.histograms.items()}
+        return {'counters': counters, 'gauges': dict(gauges, **rates), 'histograms': histograms}
+
+    def exposition(self):
+        """Métricas no formato de texto do Prometheus"""
+        gauges = self._gauge_values()
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for name, meter in sorted(self.rates.items()):
+                gauges[f"{name}_per_second"] = meter.per_second()
+            for (name, labels), value in sorted(self.counters.items()):
+                full = f"{self.prefix}_{name}_total"
+                declare(full, 'counter')
+                lines.append(f"{_series(full, labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                full = f"{self.prefix}_{name}"
+                declare(full, 'histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{_series(full + '_bucket', labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{_series(full + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{_series(full + '_count', labels)} {histogram.count}")
+        for name, value in sorted(gauges.items()):
+            if isinstance(value, (int, float)):
+                full = f"{self.prefix}_{name}"
+                declare(full, 'gauge')
+                lines.append(f"{full} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _label_key(labels):
+    # Chamado a cada pedido: ordenar só quando há mais de um rótulo
+    if len(labels) > 1:
+        return tuple(sorted(labels.items()))
+    return tuple(labels.items())
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
@@ -1,4 +1,6 @@
 # peer.py - Cliente que pode fazer download e upload de arquivos
+import argparse
+import logging
 import socket
 import threading
 import json
@@ -6,18 +8,1391 @@ import hashlib
 import os
 import time
 import random
+import select
+import struct
+import heapq
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import islice, repeat
+from protocolo import (MAGIC, MAX_DATAGRAM_SIZE, UDP_ACTIONS, UDP_CONNECT, UDP_ERROR, UDP_PROTOCOL_ID,
+                       FileSegments, ProtocolError, full_bitfield, pack_bitfield, pack_udp_request, read_at,
+                       recv_exact, recv_frame, recv_json, send_frame, unpack_bitfield, unpack_peers,
+                       unpack_udp_response, write_at)
+from metricas import Metrics, configure_logging
+
+PEER_IDLE_TIMEOUT = 120  # segundos que o servidor mantém uma conexão ociosa aberta
+HASH_BLOCK_SIZE = 4 * 1024 * 1024          # leitura do arquivo em blocos de 4 MiB
+HASH_TASK_SIZE = 64 * 1024 * 1024          # faixa do arquivo entregue a cada processo
+PARALLEL_HASH_MIN_SIZE = 32 * 1024 * 1024  # abaixo disso não compensa criar processos
+MIN_PIECE_SIZE = 16 * 1024
+MAX_PIECE_SIZE = 4 * 1024 * 1024
+TARGET_PIECE_COUNT = 1024  # o tamanho do pedaço cresce para manter ~1024 pedaços por arquivo
+LEGACY_PIECE_SIZE = 1024   # torrents sem 'piece_size' nos metadados usam pedaços de 1 KiB
+MAX_BAD_PIECES = 3  # pedaços corrompidos tolerados de um mesmo peer antes de descartá-lo
+HAVE_POLL_INTERVAL = 1.0  # intervalo entre consultas de pedaços novos a peers incompletos
+PARTIAL_PEER_PATIENCE = 60  # segundos sem pedaços novos antes de desistir de um peer incompleto
+PEER_RETRY_INTERVAL = 5     # espera até dar outro worker a um peer cujo worker saiu (dobra a cada saída)
+PEER_MAX_RETRIES = 3        # saídas toleradas de um peer no mesmo download antes de esquecê-lo
+PEER_CONNECT_TIMEOUT = 5    # segundos para abrir a conexão com um peer
+PEER_REQUEST_TIMEOUT = 20   # segundos sem resposta até considerar o peer travado
+ENDGAME_MAX_COPIES = 3      # peers pedindo o mesmo pedaço ao mesmo tempo no endgame
+SLOW_PEER_MIN_PIECES = 4    # pedaços medidos antes de julgar a vazão de um peer
+SLOW_PEER_RATIO = 0.2       # abaixo desta fração da vazão do melhor peer: um pedaço por vez
+DROP_PEER_RATIO = 0.05      # abaixo desta fração: o peer é descartado (se houver outros)
+RATE_SMOOTHING = 0.3        # peso da amostra nova nas médias móveis de vazão e latência
+MAX_PEER_CONNECTIONS = 128  # conexões de entrada atendidas ao mesmo tempo (uma thread cada)
+UPLOAD_SLOTS = 8            # peers recebendo pedaços ao mesmo tempo (fora o otimista)
+CHOKE_INTERVAL = 10         # segundos entre reavaliações de quem recebe pedaços
+OPTIMISTIC_UNCHOKE_ROUNDS = 3  # rodadas até sortear outro peer para o slot otimista
+CHOKED_RETRY_INTERVAL = 2   # espera do downloader antes de pedir de novo a quem o bloqueou
+UNCHOKE_IDLE_TIMEOUT = 2    # segundos sem pedir pedaços até a vaga ir para outro peer
+IDLE_CONNECTION_TIMEOUT = 3  # ociosidade a partir da qual uma conexão de entrada cede lugar a uma nova
+BUSY_RETRIES = 10           # tentativas de obter os metadados quando todos os peers estão lotados
+PIECE_CACHE_SIZE = 64 * 1024 * 1024  # bytes de pedaços populares mantidos em memória (0 desliga)
+PIECE_CACHE_SHARDS = 16     # partes do cache, cada uma com sua trava
+PIECE_CACHE_GHOSTS = 4096   # pedaços pedidos uma vez lembrados (sem os dados) para admitir no 2º pedido
+PEX_INTERVAL = 10           # segundos entre trocas de peers (PEX) com cada peer durante um download
+PEX_MIN_INTERVAL = 5        # quem pede PEX com mais frequência que isso recebe só `retry_after`
+PEX_MAX_PEERS = 50          # peers adicionados (e removidos) por mensagem PEX
+PEX_LOG_SIZE = 1024         # entradas/saídas guardadas por torrent para responder com deltas
+PEX_POLL_INTERVAL = 1.0     # frequência com que o download procura peers novos vindos do PEX
+PEX_REFRESH_FACTOR = 4      # com PEX ativo, o tracker é consultado 4x menos durante o download
+UDP_TRACKER_TIMEOUT = 0.5  # espera pela primeira resposta UDP; dobra a cada retransmissão
+UDP_TRACKER_RETRIES = 3    # tentativas por datagrama antes de voltar ao TCP
+UDP_CONNECTION_TTL = 60    # segundos em que o connection_id do tracker é reutilizado
+UDP_FALLBACK_PERIOD = 300  # segundos usando só TCP depois que o UDP falhou
+UDP_ACTION_CODES = {name: code for code, name in UDP_ACTIONS.items()}
+TRACKER_TIMEOUT = 5        # segundos de espera por uma resposta do tracker
+TRACKER_POOL_SIZE = 4      # conexões ociosas com o tracker mantidas para reuso
+ANNOUNCE_INTERVAL = 900    # segundos entre reanúncios de cada torrent (o tracker expira em 1800)
+ANNOUNCE_COALESCE = 60     # reanúncios que vencem dentro deste prazo entram no mesmo lote
+ANNOUNCE_RETRY = 60        # espera antes de repetir um lote que o tracker não recebeu
+ANNOUNCE_BATCH_SIZE = 2000  # info-hashes por pedido `announce_batch`
+PEER_ACTIONS = ('get_piece', 'get_file_info', 'get_bitfield', 'get_have', 'handshake', 'pex', 'stats')
+
+log = logging.getLogger('peer')
+
+
+def compute_info_hash(file_info):
+    """Info-hash do torrent: SHA-1 dos metadados canônicos (nome, tamanho, hashes dos pedaços)"""
+    canonical = json.dumps(file_info, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def choose_piece_size(file_size):
+    """Menor potência de dois entre 16 KiB e 4 MiB que mantém ~TARGET_PIECE_COUNT pedaços"""
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and piece_size * TARGET_PIECE_COUNT < file_size:
+        piece_size *= 2
+    return piece_size
+
+
+def piece_size_of(file_info):
+    """Tamanho do pedaço registrado nos metadados do torrent"""
+    return file_info.get('piece_size', LEGACY_PIECE_SIZE)
+
+
+def list_files(root):
+    """Arquivos de um diretório em ordem estável: [(caminho relativo com '/', tamanho)]"""
+    entries = []
+    for directory, subdirs, names in os.walk(root):
+        subdirs.sort()
+        for name in sorted(names):
+            if name.endswith((MetainfoStore.SUFFIX, BitfieldFile.SUFFIX)):
+                continue  # arquivos auxiliares do próprio peer não fazem parte do torrent
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            entries.append((relative, os.path.getsize(path)))
+    return entries
+
+
+def torrent_files(path, file_info):
+    """[(caminho absoluto, tamanho)] dos arquivos do torrent, na ordem em que os pedaços os cobrem"""
+    if 'files' not in file_info:
+        return [(path, file_info['size'])]
+    files = []
+    for entry in file_info['files']:
+        parts = entry['path'].split('/')
+        # Metadados vêm de outros peers: nada de caminhos absolutos ou que saiam do diretório
+        if not entry['path'] or entry['path'].startswith('/') or '..' in parts or '' in parts:
+            raise ProtocolError(f"Caminho inválido nos metadados: {entry['path']!r}")
+        files.append((os.path.join(path, *parts), entry['size']))
+    return files
+
+
+def _read_span(files, start, end, block_size):
+    """Lê os bytes [start, end) da concatenação dos arquivos em blocos de `block_size`.
+
+    Blocos que atravessam a divisa entre arquivos são montados num buffer;
+    no caso comum (bloco dentro de um arquivo) o bloco lido sai sem cópia.
+    """
+    buffer = bytearray()
+    position = 0  # início do arquivo atual na concatenação
+    for path, size in files:
+        file_end = position + size
+        if file_end > start and position < end:
+            with open(path, 'rb') as f:
+                f.seek(max(start - position, 0))
+                remaining = min(end, file_end) - max(start, position)
+                while remaining:
+                    chunk = f.read(min(block_size - len(buffer), remaining))
+                    if not chunk:
+                        break  # arquivo encolheu: os hashes deixam de bater
+                    remaining -= len(chunk)
+                    if not buffer and len(chunk) == block_size:
+                        yield chunk
+                        continue
+                    buffer += chunk
+                    if len(buffer) == block_size:
+                        yield bytes(buffer)
+                        buffer.clear()
+        position = file_end
+    if buffer:
+        yield bytes(buffer)
+
+
+def _hash_range(files, start, end, piece_size):
+    """Calcula os hashes dos pedaços entre `start` e `end` lendo os arquivos em blocos"""
+    digests = []
+    block_size = max(piece_size, HASH_BLOCK_SIZE - HASH_BLOCK_SIZE % piece_size)
+    for block in _read_span(files, start, end, block_size):
+        view = memoryview(block)
+        for offset in range(0, len(block), piece_size):
+            digests.append(hashlib.sha1(view[offset:offset + piece_size]).hexdigest())
+    return digests
+
+
+def hash_pieces(path, piece_size=LEGACY_PIECE_SIZE, workers=None):
+    """Hashes de todos os pedaços do arquivo, sem carregá-lo inteiro na memória.
+
+    `path` também pode ser a lista [(caminho, tamanho)] de um torrent com
+    vários arquivos: os pedaços cobrem os arquivos em sequência.
+    Arquivos grandes são divididos em faixas processadas em paralelo por um
+    pool de processos (pedaços legados de 1 KiB são pequenos demais para o
+    hashlib liberar o GIL, então threads não escalariam).
+    """
+    files = [(path, os.path.getsize(path))] if isinstance(path, str) else list(path)
+    size = sum(file_size for _, file_size in files)
+    if size < PARALLEL_HASH_MIN_SIZE or workers == 1:
+        return _hash_range(files, 0, size, piece_size)
+    
+    task_size = HASH_TASK_SIZE - HASH_TASK_SIZE % piece_size
+    starts = range(0, size, task_size)
+    ends = [min(start + task_size, size) for start in starts]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        digests = []
+        for chunk in pool.map(_hash_range, repeat(files), starts, ends, repeat(piece_size)):
+            digests.extend(chunk)
+        return digests
+
+
+class PeerBusy(ProtocolError):
+    """O peer recusou a conexão por estar no limite de conexões"""
+
+
+class PeerConnection:
+    """Conexão persistente com um peer remoto, com várias requisições em voo"""
+    
+    def __init__(self, peer, local_peer_id, max_in_flight=8, timeout=PEER_REQUEST_TIMEOUT):
+        self.peer = peer
+        self.address = (peer['host'], peer['port'])
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout  # espera máxima por cada resposta (peer travado vira socket.timeout)
+        self.pending = deque()  # (requisição, instante do envio) aguardando resposta, em ordem
+        self.latency = None  # média móvel do tempo entre pedido e resposta (s)
+        self.next_id = 0
+        self.lock = threading.Lock()  # uma thread usa a conexão por vez
+        self.legacy = False
+        self.aborted = False  # fechada de propósito: só restavam cópias já concluídas em voo
+        self.remote_peer_id = peer.get('peer_id')  # confirmado pelo handshake
+        self.download_limit = TokenBucket()  # limite de download só deste peer
+        self.sock = socket.create_connection(self.address, timeout=PEER_CONNECT_TIMEOUT)
+        self.sock.settimeout(timeout)
+        try:
+            send_frame(self.sock, {'action': 'handshake', 'peer_id': local_peer_id})
+            message = recv_frame(self.sock)
+        except (ProtocolError, ConnectionResetError):
+            message = None
+        if message is None:
+            # Peers antigos fecham a conexão ao receber um quadro binário
+            self.sock.close()
+            self.sock = None
+            self.legacy = True
+        elif message[0].get('status') != 'success':
+            # Peer no limite de conexões: recusa já no handshake
+            self.close()
+            if message[0].get('busy'):
+                raise PeerBusy(message[0].get('message', 'Peer ocupado'))
+            raise ProtocolError(message[0].get('message', 'Handshake recusado'))
+        else:
+            self.remote_peer_id = message[0].get('peer_id', self.remote_peer_id)
+    
+    def is_alive(self):
+        """Verifica (sem bloquear) se o outro lado não fechou a conexão ociosa"""
+        if self.legacy:
+            return True
+        if self.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return not readable or bool(self.sock.recv(1, socket.MSG_PEEK))
+        except OSError:
+            return False
+    
+    def send(self, request):
+        """Envia uma requisição sem esperar a resposta"""
+        request = dict(request, id=self.next_id)
+        self.next_id += 1
+        send_frame(self.sock, request)
+        self.pending.append((request, time.monotonic()))
+    
+    def receive(self):
+        """Lê a resposta da requisição mais antiga em voo"""
+        message = recv_frame(self.sock)
+        if message is None:
+            raise ProtocolError("Peer encerrou a conexão")
+        request, sent_at = self.pending.popleft()
+        elapsed = time.monotonic() - sent_at
+        self.latency = elapsed if self.latency is None else \
+            self.latency + RATE_SMOOTHING * (elapsed - self.latency)
+        response, body = message
+        if response.get('id') != request['id']:
+            raise ProtocolError(f"Resposta fora de ordem ({response.get('id')} != {request['id']})")
+        return request, response, body
+    
+    def request(self, request):
+        """Envia uma requisição e espera a resposta: retorna (cabeçalho, corpo)"""
+        with self.lock:
+            if self.legacy:
+                return self._legacy_request(request)
+            self.send(request)
+            _, response, body = self.receive()
+            return response, body
+    
+    def request_many(self, requests):
+        """Envia requisições em pipeline, mantendo até `max_in_flight` em voo.
+
+        Gera (requisição, cabeçalho, corpo) na ordem em que foram enviadas.
+        """
+        with self.lock:
+            if self.legacy:
+                for request in requests:
+                    yield (request,) + self._legacy_request(request)
+                return
+            
+            requests = iter(requests)
+            for request in islice(requests, self.max_in_flight):
+                self.send(request)
+            while self.pending:
+                result = self.receive()
+                next_request = next(requests, None)
+                if next_request is not None:
+                    self.send(next_request)
+                yield result
+    
+    def _legacy_request(self, request):
+        """Uma conexão JSON por requisição, como os peers antigos esperam"""
+        sock = socket.create_connection(self.address, timeout=PEER_CONNECT_TIMEOUT)
+        sock.settimeout(self.timeout)
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8'))
+            response = recv_json(sock)
+        finally:
+            sock.close()
+        if response is None:
+            raise ProtocolError("Peer encerrou a conexão sem responder")
+        
+        body = b''
+        if response.get('status') == 'success':
+            if request.get('action') == 'get_piece':
+                body = response.pop('piece_data').encode('latin-1')
+            elif request.get('action') == 'get_file_info':
+                body = json.dumps(response.pop('file_info')).encode('utf-8')
+        return response, body
+    
+    def close(self):
+        # Pode ser chamado por outra thread (cancelamento do endgame): o socket sai antes de fechar
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                # shutdown acorda uma thread bloqueada no recv desta conexão
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class PieceScheduler:
+    """Decide qual pedaço pedir a cada peer: o mais raro primeiro.
+
+    Cada peer puxa um pedaço novo sempre que libera espaço no seu pipeline,
+    então peers lentos recebem menos trabalho; pedaços de um peer que falha
+    voltam para a fila e são reatribuídos aos demais. Peers muito mais lentos
+    que o melhor ficam com um pedaço por vez.
+
+    Endgame: quando todos os pedaços que faltam já estão em voo, peers ociosos
+    pedem cópias deles (até ENDGAME_MAX_COPIES por pedaço, os mais antigos
+    primeiro); a primeira cópia que chega conclui o pedaço, `complete` informa
+    quem mais o tinha em voo e as outras cópias são descartadas sem conferir o
+    hash.
+    """
+    
+    def __init__(self, piece_indices):
+        self.condition = threading.Condition()
+        self.missing = set(piece_indices)
+        self.counts = dict.fromkeys(self.missing, 0)  # índice -> quantos peers têm
+        self.availability = {}  # peer -> set de índices (None = tem todos)
+        self.assigned = {}      # peer -> set de índices em voo com ele
+        self.in_flight = {}     # índice -> peer
+        self.copies = {}        # índice -> peers com cópias extras do pedido (endgame)
+        self.started = {}       # índice -> instante em que foi pedido
+        self.rates = {}         # peer -> (vazão média em bytes/s, pedaços medidos)
+        self.duplicates = 0     # pedaços recebidos depois que outra cópia já tinha chegado
+        self.retry = deque()    # pedaços devolvidos por falha, têm prioridade
+        self.order = []         # pedaços faltantes ordenados por raridade
+        self.cursors = {}       # peer -> posição em `order`
+        self.dirty = True
+    
+    @property
+    def done(self):
+        return not self.missing
+    
+    def add_peer(self, peer_key, pieces=None):
+        """Registra um peer e os pedaços que ele possui (None = todos)"""
+        with self.condition:
+            self.availability[peer_key] = pieces
+            self.assigned[peer_key] = set()
+            for index in (self.counts if pieces is None else pieces):
+                if index in self.counts:
+                    self.counts[index] += 1
+            self.dirty = True
+            self.condition.notify_all()
+    
+    def remove_peer(self, peer_key):
+        """Remove um peer e devolve para a fila os pedaços que estavam com ele"""
+        with self.condition:
+            if peer_key not in self.availability:
+                return  # nunca registrado (falhou ao conectar) ou já removido: None aqui seria "tem todos"
+            pieces = self.availability.pop(peer_key)
+            for index in (self.counts if pieces is None else pieces):
+                if index in self.counts:
+                    self.counts[index] -= 1
+            for index in list(self.assigned.get(peer_key, ())):
+                if self._unassign(peer_key, index) and index in self.missing:
+                    self.retry.append(index)
+            self.assigned.pop(peer_key, None)
+            self.rates.pop(peer_key, None)
+            self.cursors.pop(peer_key, None)
+            self.dirty = True
+            self.condition.notify_all()
+    
+    def add_pieces(self, peer_key, pieces):
+        """Atualiza a disponibilidade de um peer incompleto (mensagens `have`)"""
+        with self.condition:
+            current = self.availability.get(peer_key)
+            if current is None:
+                return
+            new = [i for i in pieces if i not in current]
+            current.update(new)
+            for index in new:
+                if index in self.counts:
+                    self.counts[index] += 1
+            if new:
+                self.dirty = True
+                self.condition.notify_all()
+    
+    def set_complete(self, peer_key):
+        """O peer terminou o próprio download e agora tem todos os pedaços"""
+        with self.condition:
+            current = self.availability.get(peer_key)
+            if current is not None:
+                self.add_pieces(peer_key, [i for i in self.counts if i not in current])
+                self.availability[peer_key] = None
+    
+    def _has(self, peer_key, index):
+        pieces = self.availability.get(peer_key)
+        return pieces is None or index in pieces
+    
+    def _rebuild_order(self):
+        # Empates na raridade são sorteados para que peers diferentes
+        # espalhem pedaços diferentes pelo enxame
+        self.order = sorted(self.missing, key=lambda i: (self.counts[i], random.random()))
+        self.cursors = dict.fromkeys(self.cursors, 0)
+        self.dirty = False
+    
+    def record(self, peer_key, size, elapsed):
+        """Registra um pedaço de `size` bytes recebido em `elapsed` segundos (vazão do peer)"""
+        with self.condition:
+            rate = size / max(elapsed, 1e-6)
+            average, samples = self.rates.get(peer_key, (rate, 0))
+            self.rates[peer_key] = (average + RATE_SMOOTHING * (rate - average), samples + 1)
+    
+    def rate(self, peer_key):
+        return self.rates.get(peer_key, (0, 0))[0]
+    
+    def _relative_rate(self, peer_key):
+        """Vazão do peer como fração da do melhor peer ativo (None sem medidas suficientes)"""
+        average, samples = self.rates.get(peer_key, (0, 0))
+        if samples < SLOW_PEER_MIN_PIECES:
+            return None
+        best = max(rate for rate, count in self.rates.values() if count >= SLOW_PEER_MIN_PIECES)
+        return average / best if best else None
+    
+    def _is_slow(self, peer_key):
+        relative = self._relative_rate(peer_key)
+        return relative is not None and relative < SLOW_PEER_RATIO
+    
+    def should_drop(self, peer_key):
+        """O peer é tão mais lento que os outros que vale mais devolver os pedaços dele"""
+        with self.condition:
+            relative = self._relative_rate(peer_key)
+            return relative is not None and relative < DROP_PEER_RATIO and len(self.availability) > 1
+    
+    def next_piece(self, peer_key):
+        """Reserva o próximo pedaço para `peer_key` ou retorna None se não há nenhum"""
+        with self.condition:
+            if peer_key not in self.availability:
+                return None
+            slow = self._is_slow(peer_key)
+            if slow and self.assigned[peer_key]:
+                return None  # peer lento: só recebe outro pedaço quando entregar o atual
+            for _ in range(len(self.retry)):
+                index = self.retry.popleft()
+                if index not in self.missing or index in self.in_flight:
+                    continue
+                if self._has(peer_key, index):
+                    return self._assign(peer_key, index)
+                self.retry.append(index)
+            
+            if self.dirty:
+                self._rebuild_order()
+            position = self.cursors.get(peer_key, 0)
+            while position < len(self.order):
+                index = self.order[position]
+                position += 1
+                if index in self.missing and index not in self.in_flight and self._has(peer_key, index):
+                    self.cursors[peer_key] = position
+                    return self._assign(peer_key, index)
+            self.cursors[peer_key] = position
+            
+            index = None if slow else self._endgame_piece(peer_key)
+            if index is not None:
+                self.copies.setdefault(index, set()).add(peer_key)
+                self.assigned[peer_key].add(index)
+            return index
+    
+    def _endgame_piece(self, peer_key):
+        """Pedaço em voo com outro peer que `peer_key` pode pedir em paralelo (só no endgame)"""
+        if self.retry or len(self.in_flight) < len(self.missing):
+            return None  # ainda há pedaços que ninguém pediu
+        best = None
+        for index, holder in self.in_flight.items():
+            if holder == peer_key or index in self.assigned[peer_key] or not self._has(peer_key, index):
+                continue
+            copies = len(self.copies.get(index, ()))
+            if copies + 1 >= ENDGAME_MAX_COPIES:
+                continue
+            key = (copies, self.started[index])
+            if best is None or key < best[0]:
+                best = (key, index)
+        return None if best is None else best[1]
+    
+    def _assign(self, peer_key, index):
+        self.in_flight[index] = peer_key
+        self.started[index] = time.monotonic()
+        self.assigned[peer_key].add(index)
+        return index
+    
+    def _unassign(self, peer_key, index):
+        """Tira o pedaço de `peer_key`; retorna True se nenhum outro peer o está baixando"""
+        self.assigned.get(peer_key, set()).discard(index)
+        copies = self.copies.get(index)
+        if copies and peer_key in copies:
+            copies.discard(peer_key)
+        elif self.in_flight.get(index) == peer_key:
+            del self.in_flight[index]
+            if copies:
+                self.in_flight[index] = copies.pop()  # uma cópia do endgame vira o pedido principal
+        if not copies:
+            self.copies.pop(index, None)
+        return index not in self.in_flight
+    
+    def complete(self, peer_key, index):
+        """Marca o pedaço como baixado.
+
+        Retorna os outros peers que ainda o tinham em voo (cópias do endgame),
+        ou None se ele já tinha chegado.
+        """
+        with self.condition:
+            self._unassign(peer_key, index)
+            if index not in self.missing:
+                self.duplicates += 1
+                return None
+            self.missing.discard(index)
+            # As cópias pedidas a outros peers deixam de contar no pipeline deles
+            holders = self.copies.pop(index, set())
+            holder = self.in_flight.pop(index, None)
+            if holder is not None:
+                holders.add(holder)
+            for other in holders:
+                self.assigned.get(other, set()).discard(index)
+            self.condition.notify_all()
+            return holders
+    
+    def release(self, peer_key, index, unavailable=False):
+        """Devolve um pedaço que o peer não entregou (opcionalmente: ele não o tem)"""
+        with self.condition:
+            nobody_else = self._unassign(peer_key, index)
+            if unavailable and peer_key in self.availability:
+                pieces = self.availability[peer_key]
+                if pieces is None:
+                    pieces = self.availability[peer_key] = set(self.counts)
+                if index in pieces:
+                    pieces.discard(index)
+                    self.counts[index] -= 1
+            if nobody_else and index in self.missing:
+                self.retry.append(index)
+            self.condition.notify_all()
+    
+    def wait_done(self, timeout):
+        """Espera até o download terminar ou o tempo acabar"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.missing, timeout)
+    
+    def wait_for_work(self, peer_key, timeout=None):
+        """Bloqueia até haver pedaço que `peer_key` possa baixar.
+
+        Retorna False quando o download terminou, quando o peer não tem mais
+        nada útil ou, com `timeout`, quando o tempo acabou sem trabalho novo.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.missing:
+                if any(i not in self.in_flight and self._has(peer_key, i) for i in self.missing):
+                    self.cursors[peer_key] = 0
+                    return True
+                if not self._is_slow(peer_key) and self._endgame_piece(peer_key) is not None:
+                    return True
+                if deadline is None:
+                    if not any(self._has(peer_key, i) for i in self.in_flight):
+                        return False
+                    # Pedaços úteis estão com outros peers: espera conclusão ou falha
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return False
+
+
+class FileStorage:
+    """Arquivo aberto uma única vez e acessado por offset.
+
+    Com `size`, abre para escrita (download) e pré-aloca o arquivo no
+    tamanho final, para que cada pedaço seja gravado direto na sua posição.
+    O conteúdo existente é preservado para permitir retomar downloads.
+    """
+    
+    def __init__(self, path, size=None, piece_size=LEGACY_PIECE_SIZE):
+        self.path = path
+        self.piece_size = piece_size
+        if size is None:
+            self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self.size = os.fstat(self.fd).st_size
+            return
+        
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self.fd = os.open(path, flags, 0o644)
+        self.size = size
+        if os.fstat(self.fd).st_size > size:
+            os.ftruncate(self.fd, size)
+        if size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+                return
+            except OSError:
+                pass  # sistema de arquivos sem suporte: cai para truncate
+        os.ftruncate(self.fd, size)
+    
+    def segments(self, offset, length):
+        """Trechos do disco que compõem o intervalo (para envio via sendfile)"""
+        return FileSegments([(self.fd, offset, length)])
+    
+    def piece_range(self, piece_index):
+        """(offset, tamanho) do pedaço, ou None se o índice está fora do arquivo"""
+        start = piece_index * self.piece_size
+        if piece_index < 0 or start >= self.size:
+            return None
+        return start, min(self.piece_size, self.size - start)
+    
+    def read(self, offset, length):
+        return read_at(self.fd, offset, length)
+    
+    def write(self, offset, data):
+        write_at(self.fd, offset, data)
+    
+    def close(self):
+        os.close(self.fd)
+
+
+class MultiFileStorage(FileStorage):
+    """Torrent com vários arquivos visto como um único intervalo contínuo de bytes.
+
+    Os pedaços atravessam as divisas entre arquivos; o arquivo de cada offset
+    é achado por busca binária nos inícios acumulados. Os descritores são
+    abertos sob demanda e ficam abertos (trechos enviados via sendfile os usam).
+    """
+    
+    def __init__(self, root, files, piece_size=LEGACY_PIECE_SIZE, writable=False):
+        self.path = root
+        self.piece_size = piece_size
+        self.paths = [path for path, _ in files]
+        self.sizes = [size for _, size in files]
+        self.starts = []  # offset de cada arquivo na concatenação (ordenado)
+        self.size = 0
+        for size in self.sizes:
+            self.starts.append(self.size)
+            self.size += size
+        self.flags = (os.O_RDWR if writable else os.O_RDONLY) | getattr(os, 'O_BINARY', 0)
+        self.fds = {}
+        self.fds_lock = threading.Lock()
+        if writable:
+            # Cria a árvore com cada arquivo no tamanho final (inclusive os vazios)
+            for path, size in files:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+                try:
+                    if os.fstat(fd).st_size != size:
+                        os.ftruncate(fd, size)
+                finally:
+                    os.close(fd)
+    
+    def _fd(self, index):
+        fd = self.fds.get(index)
+        if fd is None:
+            with self.fds_lock:
+                fd = self.fds.get(index)
+                if fd is None:
+                    fd = self.fds[index] = os.open(self.paths[index], self.flags)
+        return fd
+    
+    def _spans(self, offset, length):
+        """(índice do arquivo, offset dentro dele, tamanho) de cada parte do intervalo"""
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.sizes):
+            within = offset - self.starts[index]
+            count = min(length, self.sizes[index] - within)
+            if count > 0:  # arquivos vazios não ocupam espaço no intervalo
+                yield index, within, count
+                offset += count
+                length -= count
+            index += 1
+    
+    def segments(self, offset, length):
+        return FileSegments([(self._fd(index), within, count)
+                             for index, within, count in self._spans(offset, length)])
+    
+    def read(self, offset, length):
+        return b''.join(read_at(self._fd(index), within, count)
+                        for index, within, count in self._spans(offset, length))
+    
+    def write(self, offset, data):
+        view = memoryview(data)
+        for index, within, count in self._spans(offset, len(view)):
+            write_at(self._fd(index), within, view[:count])
+            view = view[count:]
+    
+    def close(self):
+        with self.fds_lock:
+            fds, self.fds = self.fds, {}
+        for fd in fds.values():
+            os.close(fd)
+
+
+def open_storage(path, file_info, writable=False):
+    """FileStorage (um arquivo) ou MultiFileStorage (diretório) do torrent descrito por `file_info`"""
+    piece_size = piece_size_of(file_info)
+    if 'files' in file_info:
+        return MultiFileStorage(path, torrent_files(path, file_info), piece_size, writable)
+    return FileStorage(path, size=file_info['size'] if writable else None, piece_size=piece_size)
+
+
+class BitfieldFile:
+    """Bitfield dos pedaços já verificados de um download, gravado em `<destino>.bitfield`.
+
+    Cada pedaço concluído altera só o byte correspondente no disco, então
+    manter o arquivo atualizado custa O(1) por pedaço.
+    """
+    
+    SUFFIX = '.bitfield'
+    HEADER = struct.Struct('!4s20sI')  # magic, info-hash, número de pedaços
+    MAGIC = b'MBTB'
+    
+    def __init__(self, save_path, torrent_hash, piece_count):
+        self.path = save_path + self.SUFFIX
+        self.piece_count = piece_count
+        self.lock = threading.Lock()
+        header = self.HEADER.pack(self.MAGIC, bytes.fromhex(torrent_hash), piece_count)
+        
+        self.bits = bytearray((piece_count + 7) // 8)
+        try:
+            with open(self.path, 'rb') as f:
+                saved = f.read()
+            if saved[:self.HEADER.size] == header:
+                self.bits[:] = saved[self.HEADER.size:self.HEADER.size + len(self.bits)].ljust(len(self.bits), b'\0')
+        except OSError:
+            pass
+        
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        os.ftruncate(self.fd, 0)
+        write_at(self.fd, 0, header + bytes(self.bits))
+    
+    def pieces(self):
+        return unpack_bitfield(self.bits, self.piece_count)
+    
+    def has(self, index):
+        return 0 <= index < self.piece_count and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+    
+    def reset(self, pieces):
+        """Substitui o conteúdo (ex.: após descartar pedaços que falharam na verificação)"""
+        with self.lock:
+            self.bits[:] = pack_bitfield(pieces, self.piece_count)
+            write_at(self.fd, self.HEADER.size, bytes(self.bits))
+    
+    def set(self, index):
+        with self.lock:
+            self.bits[index >> 3] |= 0x80 >> (index & 7)
+            write_at(self.fd, self.HEADER.size + (index >> 3), bytes([self.bits[index >> 3]]))
+    
+    def close(self, remove=False):
+        os.close(self.fd)
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class TrackerClient:
+    """Conexões persistentes com o tracker (quadros MBT1), reaproveitadas entre pedidos.
+
+    Cada pedido pega uma conexão ociosa do pool (ou abre uma nova) e a devolve
+    ao terminar, então threads diferentes não esperam umas pelas outras. O
+    tracker fecha conexões ociosas: se uma conexão reaproveitada falhar, o
+    pedido é repetido uma vez numa conexão nova.
+    """
+    
+    def __init__(self, address, pool_size=TRACKER_POOL_SIZE, timeout=TRACKER_TIMEOUT):
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+    
+    def request(self, request):
+        """Envia um pedido e retorna (cabeçalho, corpo) da resposta"""
+        while True:
+            with self.lock:
+                sock = self.idle.pop() if self.idle else None
+            reused = sock is not None
+            if not reused:
+                sock = socket.create_connection(self.address, timeout=self.timeout)
+            try:
+                send_frame(sock, request)
+                message = recv_frame(sock)
+                if message is None:
+                    raise ProtocolError("Tracker fechou a conexão sem responder")
+            except (OSError, ProtocolError):
+                sock.close()
+                if reused:
+                    continue  # conexão velha fechada pelo tracker: tenta numa nova
+                raise
+            self._release(sock)
+            return message
+    
+    def _release(self, sock):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(sock)
+                return
+        sock.close()
+    
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock in idle:
+            sock.close()
+
+
+class TokenBucket:
+    """Limite de taxa em bytes/s compartilhado entre threads (`rate` None = sem limite).
+
+    Até `burst` bytes passam de imediato; além disso quem consome espera os
+    tokens que faltam. Pedaços maiores que o `burst` deixam o saldo negativo
+    e a espera é paga por inteiro, então a taxa média sempre é respeitada.
+    """
+    
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            burst = self.burst or self.rate  # padrão: um segundo de tráfego
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class Choker:
+    """Escolhe quais peers recebem pedaços deste peer (unchoked).
+
+    Há `slots` vagas mais uma otimista. A cada CHOKE_INTERVAL as vagas vão para
+    os peers interessados que mais nos enviaram dados na rodada (reciprocidade)
+    e, em seguida, para os que mais receberam (quem baixa mais rápido, o que
+    vale para seeders). A vaga otimista é sorteada entre os bloqueados a cada
+    OPTIMISTIC_UNCHOKE_ROUNDS rodadas, para dar chance a peers novos. Enquanto
+    houver vaga livre, um peer novo entra sem esperar a próxima rodada.
+    """
+    
+    def __init__(self, slots=UPLOAD_SLOTS, interval=CHOKE_INTERVAL):
+        self.slots = slots
+        self.interval = interval
+        self.unchoked = set()
+        self.optimistic = None
+        self.interested = {}  # peer -> instante do último pedido de pedaço
+        self.downloaded = {}  # peer -> bytes recebidos dele nesta rodada
+        self.uploaded = {}    # peer -> bytes enviados a ele nesta rodada
+        self.rounds = 0
+        self.lock = threading.Lock()
+    
+    def allow(self, peer_id):
+        """Registra o interesse do peer e diz se ele pode receber um pedaço agora"""
+        if not self.slots:
+            return True
+        with self.lock:
+            self.interested[peer_id] = time.monotonic()
+            if peer_id in self.unchoked or peer_id == self.optimistic:
+                return True
+            if len(self.unchoked) >= self.slots:
+                # Quem terminou de baixar fica com a conexão aberta, mas para de pedir
+                idle = [other for other in self.unchoked
+                        if self.interested.get(other, 0) < time.monotonic() - UNCHOKE_IDLE_TIMEOUT]
+                if not idle:
+                    return False
+                self.unchoked.discard(idle[0])
+            self.unchoked.add(peer_id)
+            return True
+    
+    def record_upload(self, peer_id, size):
+        with self.lock:
+            self.uploaded[peer_id] = self.uploaded.get(peer_id, 0) + size
+    
+    def record_download(self, peer_id, size):
+        with self.lock:
+            self.downloaded[peer_id] = self.downloaded.get(peer_id, 0) + size
+    
+    def disconnected(self, peer_id):
+        with self.lock:
+            self.interested.pop(peer_id, None)
+            self.unchoked.discard(peer_id)
+            if self.optimistic == peer_id:
+                self.optimistic = None
+    
+    def rechoke(self):
+        with self.lock:
+            # Quem não pede pedaços há duas rodadas deixa de disputar vaga
+            cutoff = time.monotonic() - 2 * self.interval
+            self.interested = {peer_id: last for peer_id, last in self.interested.items() if last >= cutoff}
+            ranked = sorted(self.interested, reverse=True,
+                            key=lambda peer_id: (self.downloaded.get(peer_id, 0),
+                                                 self.uploaded.get(peer_id, 0), random.random()))
+            self.unchoked = set(ranked[:self.slots])
+            
+            self.rounds += 1
+            if (self.rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0 or self.optimistic in self.unchoked
+                    or self.optimistic not in self.interested):
+                choked = ranked[self.slots:]
+                self.optimistic = random.choice(choked) if choked else None
+            self.downloaded.clear()
+            self.uploaded.clear()
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.rechoke()
+
+
+class _CacheShard:
+    """Uma parte do PieceCache: LRU própria, trava própria e uma fatia do orçamento"""
+    
+    def __init__(self, budget, ghosts):
+        self.budget = budget
+        self.ghost_limit = ghosts
+        self.entries = OrderedDict()  # chave -> bytes do pedaço (o fim é o mais recente)
+        self.ghosts = OrderedDict()   # chaves pedidas uma vez desde que saíram (ou nunca entraram)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def _evict(self):
+        while self.size > self.budget:
+            key, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+            self._remember(key)
+    
+    def _remember(self, key):
+        self.ghosts[key] = None
+        if len(self.ghosts) > self.ghost_limit:
+            self.ghosts.popitem(last=False)
+
+
+class PieceCache:
+    """Cache LRU, limitado em bytes, dos pedaços servidos recentemente.
+    
+    Quando um torrent novo aparece, dezenas de leechers pedem os mesmos
+    primeiros pedaços quase ao mesmo tempo. As chaves se espalham por
+    PIECE_CACHE_SHARDS partes independentes, então threads de upload que
+    servem pedaços diferentes não disputam a mesma trava. Um pedaço só é
+    copiado para a memória no segundo pedido: os pedidos únicos continuam
+    saindo do disco por sendfile, sem cópia, e não expulsam os populares.
+    """
+    
+    def __init__(self, budget=PIECE_CACHE_SIZE, shards=PIECE_CACHE_SHARDS, ghosts=PIECE_CACHE_GHOSTS):
+        self.shards = [_CacheShard(budget // shards, max(1, ghosts // shards)) for _ in range(shards)]
+    
+    @property
+    def budget(self):
+        return sum(shard.budget for shard in self.shards)
+    
+    @budget.setter
+    def budget(self, budget):
+        for shard in self.shards:
+            with shard.lock:
+                shard.budget = budget // len(self.shards)
+                shard._evict()
+    
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+    
+    def lookup(self, key):
+        """Retorna (dados, admitir): os bytes do pedaço se em cache; senão se vale guardá-lo"""
+        shard = self._shard(key)
+        with shard.lock:
+            if not shard.budget:
+                shard.misses += 1  # desligado: toda leitura vai ao disco
+                return None, False
+            data = shard.entries.get(key)
+            if data is not None:
+                shard.entries.move_to_end(key)
+                shard.hits += 1
+                return data, False
+            shard.misses += 1
+            if key in shard.ghosts:
+                del shard.ghosts[key]
+                return None, True
+            shard._remember(key)
+            return None, False
+    
+    def put(self, key, data):
+        shard = self._shard(key)
+        if len(data) > shard.budget:
+            return
+        with shard.lock:
+            old = shard.entries.pop(key, None)
+            if old is not None:
+                shard.size -= len(old)
+            shard.entries[key] = data
+            shard.size += len(data)
+            shard._evict()
+    
+    def discard(self, torrent_hash):
+        """Esquece os pedaços de um torrent (ex.: o arquivo servido mudou)"""
+        for shard in self.shards:
+            with shard.lock:
+                for key in [key for key in shard.entries if key[0] == torrent_hash]:
+                    shard.size -= len(shard.entries.pop(key))
+    
+    def stats(self):
+        totals = dict.fromkeys(('bytes', 'entries', 'hits', 'misses', 'evictions'), 0)
+        for shard in self.shards:
+            with shard.lock:
+                totals['bytes'] += shard.size
+                totals['entries'] += len(shard.entries)
+                totals['hits'] += shard.hits
+                totals['misses'] += shard.misses
+                totals['evictions'] += shard.evictions
+        return totals
+
+
+class PeerExchange:
+    """Peers ativos de cada torrent, para a troca de peers (PEX) sem passar pelo tracker.
+    
+    Entram os peers de quem este baixa e os que se apresentam numa requisição
+    `pex`; saem quando o worker ou a conexão termina. O mesmo peer pode chegar
+    pelos dois caminhos, então cada entrada conta referências. Entradas e
+    saídas vão para um log por torrent: quem pergunta com `since` recebe só o
+    saldo desde então, até PEX_MAX_PEERS de cada tipo. Quem pergunta pela
+    primeira vez, ou ficou para trás do início do log, recebe uma amostra dos
+    peers atuais.
+    """
+    
+    def __init__(self):
+        self.swarms = {}  # hash -> {(host, porta): [peer, referências]}
+        self.logs = {}    # hash -> [posição do primeiro evento guardado, [(entrou?, (host, porta)), ...]]
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return sum(len(swarm) for swarm in self.swarms.values())
+    
+    def add(self, torrent_hash, peer):
+        key = (peer['host'], peer['port'])
+        with self.lock:
+            swarm = self.swarms.setdefault(torrent_hash, {})
+            entry = swarm.get(key)
+            if entry is not None:
+                entry[1] += 1
+                return
+            swarm[key] = [peer, 1]
+            self._log(torrent_hash, True, key)
+    
+    def drop(self, torrent_hash, peer):
+        key = (peer['host'], peer['port'])
+        with self.lock:
+            swarm = self.swarms.get(torrent_hash, {})
+            entry = swarm.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del swarm[key]
+            self._log(torrent_hash, False, key)
+    
+    def _log(self, torrent_hash, added, key):
+        position = self.logs.setdefault(torrent_hash, [0, []])
+        events = position[1]
+        events.append((added, key))
+        if len(events) > PEX_LOG_SIZE:
+            # Descarta a metade mais antiga de uma vez (amortizado O(1) por evento)
+            trim = len(events) - PEX_LOG_SIZE // 2
+            del events[:trim]
+            position[0] += trim
+    
+    def delta(self, torrent_hash, since, exclude=None):
+        """Retorna (peers que entraram, endereços que saíram, nova posição) desde `since`"""
+        with self.lock:
+            swarm = self.swarms.get(torrent_hash, {})
+            base, events = self.logs.get(torrent_hash, (0, []))
+            seq = base + len(events)
+            if not isinstance(since, int) or not base <= since <= seq:
+                added, dropped = [key for key in swarm if key != exclude], []
+            else:
+                changes = {}  # só vale o último evento de cada peer
+                for was_added, key in events[since - base:]:
+                    changes[key] = was_added
+                added = [key for key, was_added in changes.items()
+                         if was_added and key in swarm and key != exclude]
+                dropped = [key for key, was_added in changes.items() if not was_added and key not in swarm]
+            if len(added) > PEX_MAX_PEERS:
+                added = random.sample(added, PEX_MAX_PEERS)
+            peers = [swarm[key][0] for key in added]
+        return peers, [{'host': host, 'port': port} for host, port in dropped[:PEX_MAX_PEERS]], seq
+
+
+class PieceIndex:
+    """Onde cada pedaço já existe em disco, somando todos os torrents deste peer.
+    
+    A chave é (SHA-1, tamanho) do pedaço e o valor, os (info-hash, offset) que
+    o contêm. Versões de um mesmo conjunto de dados costumam ter muitos pedaços
+    iguais, e o downloader copia esses pedaços do disco em vez de pedi-los à
+    rede. Só casam pedaços com o mesmo alinhamento (mesmo tamanho de pedaço e
+    mesmo offset relativo), e a cópia é sempre reconferida pelo SHA-1, porque
+    o arquivo de origem pode ter mudado depois de indexado.
+    """
+    
+    def __init__(self):
+        self.locations = {}  # (sha1, tamanho) -> [(info-hash, offset)]
+        self.indexed = set()  # info-hashes já incluídos
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.locations)
+    
+    def add(self, torrent_hash, file_info):
+        piece_size = piece_size_of(file_info)
+        with self.lock:
+            if torrent_hash in self.indexed:
+                return  # o info-hash vem do conteúdo: mesmos metadados, mesmos pedaços
+            self.indexed.add(torrent_hash)
+            for index, piece in enumerate(file_info['pieces']):
+                self.locations.setdefault((piece['hash'], piece['size']), []).append(
+                    (torrent_hash, index * piece_size))
+    
+    def find(self, piece_hash, size):
+        with self.lock:
+            return list(self.locations.get((piece_hash, size), ()))
+    
+    def discard(self, piece_hash, size, location):
+        """Esquece uma cópia que não confere mais (arquivo alterado ou removido)"""
+        key = (piece_hash, size)
+        with self.lock:
+            locations = self.locations.get(key, [])
+            if location in locations:
+                locations.remove(location)
+            if not locations:
+                self.locations.pop(key, None)
+
+
+class AnnounceScheduler:
+    """Uma única thread reanuncia todos os torrents do peer, em lotes.
+
+    Em vez de um timer por torrent, guarda o próximo anúncio de cada um num
+    heap; quando o primeiro vence, todos os que venceriam nos próximos
+    ANNOUNCE_COALESCE segundos vão juntos num `announce_batch`.
+    """
+    
+    def __init__(self, peer, interval=ANNOUNCE_INTERVAL):
+        self.peer = peer
+        self.interval = interval
+        self.due = {}   # hash -> instante do próximo anúncio
+        self.heap = []  # (instante, hash); entradas antigas são ignoradas ao sair
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def __len__(self):
+        return len(self.due)
+    
+    def add(self, torrent_hash, delay=None):
+        """(Re)agenda o torrent; sem `delay`, o próximo anúncio sai daqui a um intervalo"""
+        when = time.time() + (self.interval if delay is None else delay)
+        with self.condition:
+            self.due[torrent_hash] = when
+            heapq.heappush(self.heap, (when, torrent_hash))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+    
+    def remove(self, torrent_hash):
+        with self.condition:
+            self.due.pop(torrent_hash, None)
+    
+    def _take_due(self):
+        """Espera o primeiro vencimento e retira os torrents que entram no lote"""
+        with self.condition:
+            while True:
+                while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)  # removido ou reagendado depois
+                delay = self.heap[0][0] - time.time() if self.heap else None
+                if delay is not None and delay <= 0:
+                    break
+                self.condition.wait(delay)
+            
+            limit = time.time() + ANNOUNCE_COALESCE
+            batch = []
+            while self.heap and self.heap[0][0] <= limit and len(batch) < ANNOUNCE_BATCH_SIZE:
+                when, torrent_hash = heapq.heappop(self.heap)
+                if self.due.get(torrent_hash) == when:
+                    del self.due[torrent_hash]
+                    batch.append(torrent_hash)
+            return batch
+    
+    def run(self):
+        while True:
+            batch = self._take_due()
+            if not batch:
+                continue
+            response = self.peer.announce_batch(batch)
+            if not response or response.get('status') != 'success':
+                for torrent_hash in batch:
+                    self.add(torrent_hash, ANNOUNCE_RETRY)
+                continue
+            
+            unknown = set(response.get('unknown', []))
+            for torrent_hash in batch:
+                if torrent_hash in unknown:
+                    # Tracker reiniciado sem estado: registra de novo e anuncia no próximo lote
+                    try:
+                        file_info = self.peer.get_file_info(torrent_hash)
+                    except (KeyError, OSError):
+                        continue  # o arquivo saiu do peer: deixa de anunciar
+                    self.peer.register_torrent(torrent_hash, file_info)
+                    self.add(torrent_hash, 0)
+                else:
+                    self.add(torrent_hash)
+
+
+class MetainfoStore:
+    """Metadados de cada torrent (tamanho + hashes dos pedaços) calculados uma única vez.
+
+    Ficam em memória, indexados pelo info-hash, e são gravados em
+    `<arquivo>.meta.json` ao lado dos dados para sobreviver a reinícios.
+    Uma entrada só vale enquanto o tamanho e o mtime do arquivo não mudarem.
+    Para diretórios valem a soma dos tamanhos e o mtime mais recente da árvore,
+    conferidos só ao carregar o cache (percorrer a árvore a cada pedido custaria caro).
+    """
+    
+    SUFFIX = '.meta.json'
+    
+    def __init__(self):
+        self.entries = {}  # hash -> {path, size, mtime_ns, file_info, encoded}
+        self.lock = threading.Lock()
+    
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+            if not os.path.isdir(path):
+                return st.st_size, st.st_mtime_ns
+            size, mtime_ns = 0, st.st_mtime_ns
+            for directory, _, names in os.walk(path):
+                mtime_ns = max(mtime_ns, os.stat(directory).st_mtime_ns)
+                for name in names:
+                    if not name.endswith((self.SUFFIX, BitfieldFile.SUFFIX)):
+                        st = os.stat(os.path.join(directory, name))
+                        size += st.st_size
+                        mtime_ns = max(mtime_ns, st.st_mtime_ns)
+            return size, mtime_ns
+        except OSError:
+            return None
+    
+    def get(self, torrent_hash):
+        """Retorna (file_info, file_info codificado em JSON) ou None se ausente/desatualizado"""
+        with self.lock:
+            entry = self.entries.get(torrent_hash)
+        if entry is None:
+            return None
+        if entry['multi_file']:
+            return entry['file_info'], entry['encoded']
+        if self._stat(entry['path']) != (entry['size'], entry['mtime_ns']):
+            with self.lock:
+                self.entries.pop(torrent_hash, None)
+            return None
+        return entry['file_info'], entry['encoded']
+    
+    def load(self, path):
+        """Carrega o cache gravado ao lado de `path`; retorna (info-hash, file_info) se válido"""
+        try:
+            with open(path + self.SUFFIX, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._stat(path) != (saved.get('size'), saved.get('mtime_ns')):
+            return None
+        self._add(saved['torrent_hash'], path, saved['size'], saved['mtime_ns'], saved['file_info'])
+        return saved['torrent_hash'], saved['file_info']
+    
+    def put(self, torrent_hash, path, file_info):
+        """Guarda os metadados em memória e no disco, marcados com o estado atual do arquivo"""
+        stat = self._stat(path)
+        if stat is None:
+            return
+        size, mtime_ns = stat
+        self._add(torrent_hash, path, size, mtime_ns, file_info)
+        saved = {
+            'torrent_hash': torrent_hash,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'file_info': file_info
+        }
+        try:
+            tmp_path = path + self.SUFFIX + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, path + self.SUFFIX)
+        except OSError as e:
+            log.warning("Não foi possível gravar o cache de metadados de %s: %s", path, e)
+    
+    def _add(self, torrent_hash, path, size, mtime_ns, file_info):
+        entry = {
+            'path': path,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'file_info': file_info,
+            'encoded': json.dumps(file_info).encode('utf-8'),
+            'multi_file': 'files' in file_info
+        }
+        with self.lock:
+            self.entries[torrent_hash] = entry
+
 
 class Peer:
-    def __init__(self, peer_id=None, host='localhost', port=None):
+    def __init__(self, peer_id=None, host='localhost', port=None, max_in_flight=8,
+                 tracker_host='localhost', tracker_port=8000):
         self.peer_id = peer_id or f"peer_{random.randint(1000, 9999)}"
         self.host = host
         self.port = port or random.randint(9000, 9999)
-        self.tracker_host = 'localhost'
-        self.tracker_port = 8000
+        self.tracker_host = tracker_host
+        self.tracker_port = tracker_port
+        self.compact_peers = False  # pede ao tracker listas de peers binárias (quadros MBT1)
+        self.tracker_client = None  # TrackerClient do endereço atual do tracker
+        self.announcer = AnnounceScheduler(self)  # reanúncios periódicos de todos os torrents
+        self.udp_tracker = False  # announce/get_peers por UDP, com TCP como reserva
+        self.udp_socket = None
+        self.udp_address = None  # (host, porta) do tracker para o qual o socket UDP aponta
+        self.udp_connection = None  # (connection_id, validade) obtido no connect UDP
+        self.udp_retry_at = 0  # UDP suspenso até este instante depois de uma falha
+        self.udp_lock = threading.Lock()
         self.files = {}  # hash -> file_path
-        self.downloading = {}  # hash -> {pieces: dict, total_pieces: int}
+        self.storages = {}  # hash -> FileStorage (descritor aberto para servir pedaços)
+        self.storages_lock = threading.Lock()
+        self.metainfo = MetainfoStore()
+        self.hash_workers = None  # processos para calcular hashes (None = todos os núcleos)
+        self.piece_size = None  # tamanho do pedaço em novos torrents (None = escolhe pelo tamanho)
+        self.downloading = {}  # hash -> {file_info, storage, scheduler, bitfield, have_log, ...}
+        self.max_in_flight = max_in_flight  # pedidos de pedaço em voo por conexão
+        self.max_download_peers = 16  # peers baixados em paralelo por download
+        self.peer_refresh_interval = 15  # segundos entre consultas ao tracker durante um download
+        self.connections = {}  # (host, port, torrent_hash) -> PeerConnection
+        self.connections_lock = threading.Lock()
+        # Upload sob controle: conexões de entrada limitadas, vagas de envio e taxas máximas
+        self.max_connections = MAX_PEER_CONNECTIONS
+        self.choker = Choker()  # `choker.slots = 0` desliga o choking
+        self.upload_limit = TokenBucket()    # bytes/s enviados no total (`upload_limit.rate`)
+        self.download_limit = TokenBucket()  # bytes/s recebidos no total
+        self.peer_upload_rate = None    # bytes/s enviados a cada peer (None = sem limite)
+        self.peer_download_rate = None  # bytes/s recebidos de cada peer
+        self.inbound = {}  # socket de entrada -> instante da última requisição
+        self.piece_cache = PieceCache()  # pedaços populares em memória (`piece_cache.budget = 0` desliga)
+        self.pex = PeerExchange()  # peers ativos de cada torrent, repassados a quem pede `pex`
+        self.piece_index = PieceIndex()  # hash do pedaço -> cópias locais, para não baixar o que já existe
+        self.metrics = Metrics('minibt_peer')
+        self._register_gauges()
         self.connect_to_tracker()
     
+    def _register_gauges(self):
+        """Medidores lidos só quando alguém pede as métricas"""
+        metrics = self.metrics
+        metrics.gauge('inbound_connections', lambda: len(self.inbound))
+        metrics.gauge('outbound_connections', lambda: len(self.connections))
+        metrics.gauge('unchoked_peers', lambda: len(self.choker.unchoked))
+        metrics.gauge('interested_peers', lambda: len(self.choker.interested))
+        metrics.gauge('shared_torrents', lambda: len(self.files))
+        metrics.gauge('active_downloads', lambda: len(self.downloading))
+        for name in ('bytes', 'entries', 'hits', 'misses', 'evictions'):
+            metrics.gauge(f'piece_cache_{name}', lambda name=name: self.piece_cache.stats()[name])
+        metrics.gauge('piece_cache_budget_bytes', lambda: self.piece_cache.budget)
+        metrics.gauge('pex_known_peers', lambda: len(self.pex))
+        metrics.gauge('dedup_index_pieces', lambda: len(self.piece_index))
+        metrics.gauge('pieces_missing', lambda: sum(len(download['scheduler'].missing)
+                                                    for download in list(self.downloading.values())))
+    
     
     def connect_to_tracker(self):
         """Conecta ao tracker e lista torrents disponíveis"""
@@ -36,51 +1411,243 @@ class Peer:
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((self.host, self.port))
-        server.listen(5)
-        print(f"Peer {self.peer_id} iniciado em {self.host}:{self.port}")
+        server.listen(128)
+        log.info("Peer %s iniciado em %s:%s", self.peer_id, self.host, self.port)
+        threading.Thread(target=self.choker.run, daemon=True).start()
         
+        # Cada conexão ocupa uma thread: o semáforo limita quantas existem ao mesmo tempo
+        connection_slots = threading.BoundedSemaphore(self.max_connections)
         while True:
             client, addr = server.accept()
-            thread = threading.Thread(target=self.handle_peer, args=(client, addr))
+            if not connection_slots.acquire(blocking=False):
+                # Lotado: uma conexão ociosa (ex.: de quem já terminou de baixar) cede a vaga
+                if not (self._close_idle_connection() and connection_slots.acquire(timeout=1)):
+                    self._refuse(client)
+                    continue
+            thread = threading.Thread(target=self.handle_peer, args=(client, addr, connection_slots))
             thread.daemon = True
             thread.start()
     
-    def handle_peer(self, client, addr):
-        """Processa requisições de outros peers"""
+    def _close_idle_connection(self):
+        """Encerra a conexão de entrada ociosa há mais tempo; a thread dela libera a vaga"""
+        cutoff = time.monotonic() - IDLE_CONNECTION_TIMEOUT
+        idle = [(last, client) for client, last in list(self.inbound.items()) if last < cutoff]
+        if not idle:
+            return False
         try:
-            data = client.recv(4096).decode('utf-8')
-            request = json.loads(data)
-            
-            if request['action'] == 'get_piece':
-                response = self.send_piece(request)
-            elif request['action'] == 'get_file_info':
-                response = self.send_file_info(request)
+            min(idle, key=lambda entry: entry[0])[1].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return True
+    
+    def _refuse(self, client):
+        """Responde ao handshake com erro e fecha: o downloader procura outro peer"""
+        try:
+            client.settimeout(1)
+            send_frame(client, {'status': 'error', 'message': 'Peer ocupado', 'busy': True})
+        except OSError:
+            pass
+        finally:
+            client.close()
+    
+    def handle_peer(self, client, addr, connection_slots=None):
+        """Processa requisições de outros peers (quadros binários ou JSON legado)"""
+        remote = f"{addr[0]}:{addr[1]}"  # trocado pelo peer_id do handshake
+        pex_session = None
+        try:
+            client.settimeout(PEER_IDLE_TIMEOUT)
+            head = client.recv(len(MAGIC))
+            if not head:
+                return  # conectou e fechou sem pedir nada (ex.: teste de porta)
+            if MAGIC.startswith(head):
+                head += bytes(recv_exact(client, len(MAGIC) - len(head)))
+            if head == MAGIC:
+                # Conexão persistente: atende quadros em ordem até o outro lado fechar
+                upload_limit = TokenBucket(self.peer_upload_rate)
+                pex_session = {'last': {}, 'peers': {}}  # PEX desta conexão: último pedido e endereço anunciado
+                message = recv_frame(client, head)
+                while message is not None:
+                    request, _ = message
+                    self.inbound[client] = time.monotonic()
+                    if request.get('action') == 'handshake':
+                        remote = request.get('peer_id') or remote
+                    if request.get('action') == 'get_piece' and not self.choker.allow(remote):
+                        self.metrics.count('choked_requests')
+                        response, body = {'status': 'error', 'message': 'Peer bloqueado (choked)',
+                                          'choked': True}, b''
+                    else:
+                        response, body = self.process_request(request, pex_session)
+                    if 'id' in request:
+                        response['id'] = request['id']
+                    size = body.size if isinstance(body, FileSegments) else len(body)
+                    if size:
+                        self.upload_limit.consume(size)
+                        upload_limit.consume(size)
+                        self.choker.record_upload(remote, size)
+                    self.metrics.mark('upload_bytes', send_frame(client, response, body))
+                    message = recv_frame(client)
             else:
-                response = {'status': 'error', 'message': 'Ação inválida'}
-            
-            client.send(json.dumps(response).encode('utf-8'))
+                # Peer antigo: requisição e resposta em JSON puro
+                request = recv_json(client, head)
+                response, body = self.process_request(request)
+                if isinstance(body, FileSegments):
+                    body = body.read()
+                response = self._to_legacy_response(request, response, body)
+                payload = json.dumps(response).encode('utf-8')
+                self.upload_limit.consume(len(payload))
+                client.sendall(payload)
+                self.metrics.mark('upload_bytes', len(payload))
+        except socket.timeout:
+            pass
+        except ConnectionError as e:
+            # Rotina: o downloader fecha a conexão ao cancelar cópias do endgame ou ao terminar
+            log.debug("Peer %s desconectou: %s", addr, e)
         except Exception as e:
-            print(f"Erro ao processar peer {addr}: {e}")
+            log.warning("Erro ao processar peer %s: %s", addr, e)
         finally:
+            self.inbound.pop(client, None)
             client.close()
+            if pex_session is not None:
+                for torrent_hash, peer in pex_session['peers'].items():
+                    self.pex.drop(torrent_hash, peer)
+            self.choker.disconnected(remote)
+            if connection_slots is not None:
+                connection_slots.release()
+    
+    def process_request(self, request, pex_session=None):
+        """Despacha uma requisição de peer e retorna (cabeçalho, corpo binário)"""
+        start = time.perf_counter()
+        response, body = self._dispatch(request, pex_session)
+        action = request.get('action')
+        if action not in PEER_ACTIONS:
+            action = 'invalid'
+        self.metrics.observe('request_seconds', time.perf_counter() - start, action=action)
+        if response.get('status') != 'success':
+            self.metrics.count('request_errors', action=action)
+        if action == 'get_piece' and response.get('status') == 'success':
+            self.metrics.mark('pieces_uploaded')
+        return response, body
+    
+    def _dispatch(self, request, pex_session=None):
+        action = request.get('action')
+        
+        if action == 'get_piece':
+            return self.send_piece(request)
+        elif action == 'get_file_info':
+            return self.send_file_info(request)
+        elif action == 'get_bitfield':
+            return self.send_bitfield(request)
+        elif action == 'get_have':
+            return self.send_have(request)
+        elif action == 'handshake':
+            return {'status': 'success', 'peer_id': self.peer_id}, b''
+        elif action == 'pex':
+            return self.send_pex(request, pex_session)
+        elif action == 'stats':
+            return self.send_stats(request)
+        else:
+            return {'status': 'error', 'message': 'Ação inválida'}, b''
+    
+    def send_pex(self, request, pex_session):
+        """Troca de peers: registra o endereço de quem pergunta e devolve as mudanças desde `since`"""
+        if pex_session is None:
+            return {'status': 'error', 'message': 'PEX só em conexões persistentes'}, b''
+        torrent_hash = request.get('torrent_hash')
+        if torrent_hash not in self.files and torrent_hash not in self.downloading:
+            return {'status': 'error', 'message': 'Arquivo não encontrado'}, b''
+        
+        sender = None
+        if isinstance(request.get('port'), int) and request.get('host'):
+            sender = (request['host'], request['port'])
+            if torrent_hash not in pex_session['peers']:
+                peer = {'peer_id': request.get('peer_id') or f"{sender[0]}:{sender[1]}",
+                        'host': sender[0], 'port': sender[1], 'seeder': bool(request.get('seeder'))}
+                pex_session['peers'][torrent_hash] = peer
+                self.pex.add(torrent_hash, peer)
+        
+        now = time.monotonic()
+        wait = pex_session['last'].get(torrent_hash, -PEX_MIN_INTERVAL) + PEX_MIN_INTERVAL - now
+        if wait > 0:
+            return {'status': 'success', 'added': [], 'dropped': [], 'pex_seq': request.get('since'),
+                    'retry_after': wait}, b''
+        pex_session['last'][torrent_hash] = now
+        added, dropped, seq = self.pex.delta(torrent_hash, request.get('since'), exclude=sender)
+        return {'status': 'success', 'added': added, 'dropped': dropped, 'pex_seq': seq}, b''
+    
+    def send_stats(self, request):
+        """Métricas do peer: JSON na resposta ou, com `format: text`, o formato do Prometheus no corpo"""
+        if request.get('format') == 'text':
+            return {'status': 'success', 'format': 'text'}, self.metrics.exposition().encode('utf-8')
+        return {'status': 'success', 'metrics': self.metrics.snapshot()}, b''
+    
+    def _to_legacy_response(self, request, response, body):
+        """Converte (cabeçalho, corpo) para o formato JSON dos peers antigos"""
+        if response.get('status') == 'success':
+            if request.get('action') == 'get_piece':
+                response['piece_data'] = bytes(body).decode('latin-1')
+            elif request.get('action') == 'get_file_info':
+                response['file_info'] = json.loads(bytes(body).decode('utf-8'))
+        return response
+    
+    def get_connection(self, peer, torrent_hash=None):
+        """Retorna a conexão persistente com o peer, abrindo uma se necessário.
+
+        Cada torrent tem a sua: o pipeline de um download ocupa a conexão inteira,
+        e descartá-la (erro ou peer lento) não derruba os outros torrents.
+        """
+        key = (peer['host'], peer['port'], torrent_hash)
+        with self.connections_lock:
+            connection = self.connections.get(key)
+            if connection is not None and connection.is_alive():
+                return connection
+        
+        if connection is not None:
+            self.drop_connection(peer, torrent_hash)
+        connection = PeerConnection(peer, self.peer_id, self.max_in_flight)
+        connection.download_limit.rate = self.peer_download_rate
+        with self.connections_lock:
+            # O limite por peer vale para todas as conexões com ele
+            for (host, port, _), other in self.connections.items():
+                if (host, port) == key[:2]:
+                    connection.download_limit = other.download_limit
+                    break
+            self.connections[key] = connection
+        return connection
+    
+    def drop_connection(self, peer, torrent_hash=None):
+        """Fecha e descarta a conexão com um peer (ex.: após um erro)"""
+        with self.connections_lock:
+            connection = self.connections.pop((peer['host'], peer['port'], torrent_hash), None)
+        if connection is not None:
+            connection.close()
+    
+    def request_peer(self, peer, request):
+        """Envia uma requisição a outro peer e retorna (cabeçalho, corpo)"""
+        torrent_hash = request.get('torrent_hash')
+        try:
+            return self.get_connection(peer, torrent_hash).request(request)
+        except Exception:
+            self.drop_connection(peer, torrent_hash)
+            raise
     
     def add_file(self, file_path):
-        """Adiciona arquivo e se torna seeder"""
+        """Adiciona arquivo (ou diretório inteiro, como um torrent só) e se torna seeder"""
         if not os.path.exists(file_path):
-            print(f"Arquivo {file_path} não encontrado")
+            log.warning("Arquivo %s não encontrado", file_path)
             return None
+        if os.path.isdir(file_path):
+            file_path = os.path.normpath(file_path)  # o cache fica ao lado, não dentro do diretório
         
-        with open(file_path, 'rb') as f:
-            content = f.read()
-            file_hash = hashlib.sha1(content).hexdigest()
+        # Reaproveita os hashes gravados ao lado do arquivo se ele não mudou
+        cached = self.metainfo.load(file_path)
+        if cached is not None:
+            file_hash, file_info = cached
+        else:
+            file_hash, file_info = self.hash_file(file_path)
+            self.metainfo.put(file_hash, file_path, file_info)
     
         self.files[file_hash] = file_path
-    
-        file_info = {
-            'name': os.path.basename(file_path),
-            'size': len(content),
-            'pieces': self.split_into_pieces(content)
-        }
+        self.piece_index.add(file_hash, file_info)
     
         self.register_torrent(file_hash, file_info)
     
@@ -98,7 +1665,40 @@ class Peer:
             'port': self.port,
             'is_seeder': True  # Indica que tem o arquivo completo
         }
-        return self.send_tracker_request(request)
+        response = self.send_tracker_request(request)
+        self.announcer.add(torrent_hash)
+        return response
+    
+    def hash_file(self, file_path, piece_size=None):
+        """Calcula o info-hash e os metadados (file_info) lendo o arquivo em streaming.
+
+        Um diretório vira um único torrent: `files` lista os arquivos (caminho
+        relativo e tamanho) e os pedaços cobrem o conteúdo deles em sequência.
+        """
+        entries = list_files(file_path) if os.path.isdir(file_path) else None
+        if entries is None:
+            size = os.path.getsize(file_path)
+            files = file_path
+        else:
+            size = sum(entry_size for _, entry_size in entries)
+            files = [(os.path.join(file_path, *relative.split('/')), entry_size)
+                     for relative, entry_size in entries]
+        piece_size = piece_size or self.piece_size or choose_piece_size(size)
+        digests = hash_pieces(files, piece_size, self.hash_workers)
+        
+        file_info = {
+            'name': os.path.basename(os.path.normpath(file_path)),
+            'size': size,
+            'piece_size': piece_size,
+            'pieces': [{
+                'index': index,
+                'hash': digest,
+                'size': min(piece_size, size - index * piece_size)
+            } for index, digest in enumerate(digests)]
+        }
+        if entries is not None:
+            file_info['files'] = [{'path': relative, 'size': entry_size} for relative, entry_size in entries]
+        return compute_info_hash(file_info), file_info
     
     def split_into_pieces(self, content, piece_size=1024):
         """Divide arquivo em pedaços"""
@@ -114,11 +1714,19 @@ class Peer:
         return pieces
     
     def register_torrent(self, torrent_hash, file_info):
-        """Registra torrent no tracker"""
+        """Registra torrent no tracker (só o resumo: a lista de pedaços vem dos peers)"""
+        summary = {
+            'name': file_info['name'],
+            'size': file_info['size'],
+            'piece_size': piece_size_of(file_info),
+            'piece_count': len(file_info['pieces'])
+        }
+        if 'files' in file_info:
+            summary['file_count'] = len(file_info['files'])
         request = {
             'action': 'register_torrent',
             'torrent_hash': torrent_hash,
-            'file_info': file_info
+            'file_info': summary
         }
         self.send_tracker_request(request)
     
@@ -128,49 +1736,143 @@ class Peer:
         
         
         if not response or not isinstance(response, dict):
-            print("Resposta inválida do tracker")
+            log.warning("Resposta inválida do tracker")
             return None
         
         if response and response.get('status') == 'success':
-            # Agenda próximo anúncio (a cada 15 minutos)
-            threading.Timer(900, self.announce_to_tracker, [torrent_hash]).start()
+            # Próximo anúncio (a cada 15 minutos) sai junto com os dos outros torrents
+            self.announcer.add(torrent_hash)
         return response
     
+    def announce_batch(self, torrent_hashes):
+        """Anuncia vários torrents num só pedido; a resposta lista os que o tracker não conhece"""
+        return self.send_tracker_request({
+            'action': 'announce_batch',
+            'peer_id': self.peer_id,
+            'host': self.host,
+            'port': self.port,
+            'torrents': [{'torrent_hash': torrent_hash,
+                          'is_seeder': torrent_hash in self.files and torrent_hash not in self.downloading}
+                         for torrent_hash in torrent_hashes]
+        })
+    
     def _send_announce(self, torrent_hash):
         request = {
             'action': 'announce',
             'peer_id': self.peer_id,
             'torrent_hash': torrent_hash,
             'host': self.host,
-            'port': self.port
+            'port': self.port,
+            # O tracker separa seeders e leechers por este campo (mesmo critério de announce_batch)
+            'is_seeder': torrent_hash in self.files and torrent_hash not in self.downloading
         }
         return self.send_tracker_request(request)
     
     def send_tracker_request(self, request):
-        try:
-            print(f"Conectando ao tracker em {self.tracker_host}:{self.tracker_port}")  # Log 1
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(5)  # Timeout de 5 segundos
-            sock.connect((self.tracker_host, self.tracker_port))
-            print(f"Enviando requisição: {request}")  # Log 2
-            sock.send(json.dumps(request).encode('utf-8'))
-            
-            response_data = sock.recv(4096).decode('utf-8')
+        action = request.get('action')
+        start = time.perf_counter()
+        if self.udp_tracker and action in UDP_ACTION_CODES and time.time() >= self.udp_retry_at:
             try:
-                response = json.loads(response_data)  # Converte string JSON para dict
-            except json.JSONDecodeError:
-                print(f"Resposta inválida do tracker: {response_data}")
-                return None
-            
-            sock.close()
-            return response
+                response = self._udp_tracker_request(request)
+                self.metrics.observe('tracker_request_seconds', time.perf_counter() - start,
+                                     action=action, transport='udp')
+                return response
+            except (OSError, ProtocolError) as e:
+                self.metrics.count('tracker_errors', transport='udp')
+                log.warning("Tracker não respondeu por UDP (%s); usando TCP", e)
+                self.udp_retry_at = time.time() + UDP_FALLBACK_PERIOD
+                self._close_udp_socket()
+        if self.compact_peers and action in ('announce', 'get_peers'):
+            request = dict(request, compact=True)
+        try:
+            response, body = self._tracker_connection().request(request)
+        except ProtocolError as e:
+            self.metrics.count('tracker_errors', transport='tcp')
+            log.warning("Resposta inválida do tracker: %s", e)
+            return None
         except Exception as e:
-            print(f"Erro ao conectar com tracker: {e}")
+            self.metrics.count('tracker_errors', transport='tcp')
+            log.warning("Erro ao conectar com tracker: %s", e)
             return None
+        self.metrics.observe('tracker_request_seconds', time.perf_counter() - start,
+                             action=action, transport='tcp')
+        return self._compact_response(response, body)
+    
+    def _tracker_connection(self):
+        """TrackerClient do endereço atual (tracker_host/tracker_port podem mudar depois de criado)"""
+        address = (self.tracker_host, self.tracker_port)
+        client = self.tracker_client
+        if client is None or client.address != address:
+            if client is not None:
+                client.close()
+            client = self.tracker_client = TrackerClient(address)
+        return client
+    
+    def _compact_response(self, response, body):
+        """Converte os registros compactos do corpo na lista de peers usual (peer_id = host:porta)"""
+        if 'peers4' in response:
+            response['peers'] = [{'peer_id': f"{host}:{port}", 'host': host, 'port': port}
+                                 for host, port in unpack_peers(body, response['peers4'], response['peers6'])]
+        return response
+    
+    def _udp_tracker_request(self, request):
+        """announce/get_peers em um datagrama (sem conexão TCP); levanta OSError se o tracker não responder"""
+        fields = {key: value for key, value in request.items() if key != 'action'}
+        with self.udp_lock:
+            address = (self.tracker_host, self.tracker_port)
+            if self.udp_socket is None or self.udp_address != address:
+                self._close_udp_socket()
+                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                # Socket "conectado": erros ICMP (porta fechada) chegam como exceção e o TCP assume logo
+                self.udp_socket.connect(address)
+                self.udp_address = address
+            
+            for _ in range(2):
+                if self.udp_connection is None or self.udp_connection[1] < time.time():
+                    connection_id = self._udp_exchange(UDP_PROTOCOL_ID, UDP_CONNECT, None)
+                    self.udp_connection = (connection_id, time.time() + UDP_CONNECTION_TTL)
+                action, (response, body) = self._udp_exchange(self.udp_connection[0],
+                                                              UDP_ACTION_CODES[request['action']], fields)
+                if action == UDP_ERROR and response.get('reconnect'):
+                    self.udp_connection = None  # id vencido: refaz o connect uma vez
+                    continue
+                return self._compact_response(response, body)
+            raise ProtocolError("Tracker recusou o connection_id")
+    
+    def _udp_exchange(self, connection_id, action, fields):
+        """Envia um datagrama e espera a resposta da mesma transação, retransmitindo com espera dobrada"""
+        transaction_id = random.getrandbits(32)
+        datagram = pack_udp_request(connection_id, action, transaction_id, fields)
+        timeout = UDP_TRACKER_TIMEOUT
+        for _ in range(UDP_TRACKER_RETRIES):
+            self.udp_socket.send(datagram)
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                self.udp_socket.settimeout(max(0.001, deadline - time.time()))
+                try:
+                    reply = self.udp_socket.recv(MAX_DATAGRAM_SIZE)
+                except socket.timeout:
+                    break
+                reply_action, reply_transaction, payload = unpack_udp_response(reply)
+                if reply_transaction != transaction_id:
+                    continue  # resposta atrasada de uma tentativa anterior
+                if action == UDP_CONNECT:
+                    if reply_action != UDP_CONNECT:
+                        raise ProtocolError(f"Tracker recusou o connect: {payload[0].get('message')}")
+                    return payload
+                return reply_action, payload
+            timeout *= 2
+        raise socket.timeout(f"sem resposta UDP após {UDP_TRACKER_RETRIES} tentativas")
+    
+    def _close_udp_socket(self):
+        if self.udp_socket is not None:
+            self.udp_socket.close()
+            self.udp_socket = None
+        self.udp_connection = None
     
     def download_file(self, torrent_hash, save_path):
         """Baixa arquivo e só se anuncia como peer se conseguir completar"""
-        print(f"Iniciando download do torrent {torrent_hash}")
+        log.info("Iniciando download do torrent %s", torrent_hash)
     
         # Primeiro verifica se há seeders disponíveis
         response = self.send_tracker_request({
@@ -179,7 +1881,7 @@ class Peer:
         })
     
         if not response or not response.get('peers'):
-            print("Nenhum seeder disponível para este torrent")
+            log.warning("Nenhum seeder disponível para o torrent %s", torrent_hash)
             return False
     
         # Tenta baixar o arquivo
@@ -189,141 +1891,621 @@ class Peer:
         if success:
             self.files[torrent_hash] = save_path
             self.announce_as_seeder(torrent_hash)
-            print("✓ Download concluído e agora você é um seeder!")
+            log.info("Download de %s concluído; agora este peer é um seeder", torrent_hash)
         else:
-            print("✗ Download falhou")
+            log.warning("Download de %s falhou", torrent_hash)
     
         return success
     
     def download_from_peers(self, torrent_hash, peers, save_path):
         """Baixa arquivo de peers disponíveis"""
-        for peer in peers:
-            try:
-                # Conecta com peer
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((peer['host'], peer['port']))
-                
-                # Solicita informações do arquivo
-                request = {
-                    'action': 'get_file_info',
-                    'torrent_hash': torrent_hash
-                }
-                sock.send(json.dumps(request).encode('utf-8'))
-                response = json.loads(sock.recv(4096).decode('utf-8'))
-                sock.close()
-                
-                if response.get('status') == 'success':
-                    file_info = response['file_info']
-                    return self.download_pieces(torrent_hash, peers, file_info, save_path)
-                    
-            except Exception as e:
-                print(f"Erro ao conectar com peer {peer['peer_id']}: {e}")
-                continue
-        
-        return False
-    
-    def download_pieces(self, torrent_hash, peers, file_info, save_path):
-        """Baixa pedaços do arquivo"""
-        pieces = file_info['pieces']
-        downloaded_pieces = {}
-        
-        for piece_info in pieces:
-            piece_index = piece_info['index']
-            
-            # Tenta baixar o pedaço de algum peer
-            for peer in peers:
+        candidates = list(peers)
+        for _ in range(BUSY_RETRIES):
+            busy = []  # peers no limite de conexões: vale tentar de novo daqui a pouco
+            for peer in candidates:
                 try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect((peer['host'], peer['port']))
-                    
+                    # Solicita informações do arquivo
                     request = {
-                        'action': 'get_piece',
-                        'torrent_hash': torrent_hash,
-                        'piece_index': piece_index
+                        'action': 'get_file_info',
+                        'torrent_hash': torrent_hash
                     }
-                    sock.send(json.dumps(request).encode('utf-8'))
-                    response = json.loads(sock.recv(8192).decode('utf-8'))
-                    sock.close()
+                    response, body = self.request_peer(peer, request)
                     
                     if response.get('status') == 'success':
-                        piece_data = response['piece_data'].encode('latin-1')
-                        downloaded_pieces[piece_index] = piece_data
-                        print(f"Baixado pedaço {piece_index}/{len(pieces)-1}")
-                        break
-                        
+                        file_info = json.loads(bytes(body).decode('utf-8'))
+                        # Os hashes dos pedaços só valem se os metadados forem os do info-hash pedido.
+                        # Em torrents legados (sem 'piece_size') o info-hash é o SHA-1 do conteúdo,
+                        # conferido por download_pieces quando o arquivo fica completo
+                        if 'piece_size' in file_info and compute_info_hash(file_info) != torrent_hash:
+                            log.warning("Peer %s enviou metadados que não conferem com o info-hash %s",
+                                        peer['peer_id'], torrent_hash)
+                            continue
+                        return self.download_pieces(torrent_hash, peers, file_info, save_path)
+                
+                except PeerBusy:
+                    busy.append(peer)
                 except Exception as e:
-                    print(f"Erro ao baixar pedaço {piece_index} do peer {peer['peer_id']}: {e}")
+                    log.warning("Erro ao conectar com peer %s: %s", peer['peer_id'], e)
                     continue
+            if not busy:
+                break
+            candidates = busy
+            time.sleep(CHOKED_RETRY_INTERVAL)
         
-        # Reconstrói arquivo
-        if len(downloaded_pieces) == len(pieces):
-            with open(save_path, 'wb') as f:
-                for i in range(len(pieces)):
-                    f.write(downloaded_pieces[i])
-            print(f"Download concluído: {save_path}")
+        return False
+    
+    def download_pieces(self, torrent_hash, peers, file_info, save_path):
+        """Baixa pedaços de todos os peers em paralelo, gravando cada um direto no arquivo.
+
+        Se um download anterior para o mesmo destino foi interrompido, os
+        pedaços marcados no bitfield são conferidos e só os que faltam são baixados.
+        """
+        pieces = file_info['pieces']
+        storage = open_storage(save_path, file_info, writable=True)
+        bitfield = BitfieldFile(save_path, torrent_hash, len(pieces))
+        have = self._verify_resumed_pieces(storage, file_info, bitfield.pieces())
+        if have:
+            log.info("Retomando download: %d/%d pedaços já verificados", len(have), len(pieces))
+        have |= self._copy_local_pieces(torrent_hash, file_info, storage, have)
+        bitfield.reset(have)
+        
+        download = {
+            'file_info': file_info,
+            'encoded_info': json.dumps(file_info).encode('utf-8'),
+            'save_path': save_path,
+            'storage': storage,
+            'bitfield': bitfield,
+            'have_log': [],  # pedaços concluídos nesta sessão, em ordem (para `get_have`)
+            'discovered': deque(),  # peers recebidos por PEX ainda sem worker
+            'pex_active': False,  # algum peer respondeu ao PEX: o tracker pode ser consultado menos
+            'connections': {},  # peer -> conexão do worker (para cancelar cópias do endgame)
+            'scheduler': PieceScheduler(i for i in range(len(pieces)) if i not in have)
+        }
+        # A partir daqui os pedaços já verificados podem ser servidos a outros peers
+        self.downloading[torrent_hash] = download
+        
+        try:
+            if not download['scheduler'].done:
+                self._run_download_workers(torrent_hash, peers, download)
+        finally:
+            done = download['scheduler'].done
+            if done and 'piece_size' not in file_info and self._content_hash(storage, file_info['size']) != torrent_hash:
+                log.warning("Conteúdo baixado não confere com o info-hash %s", torrent_hash)
+                done = False
+            if done:
+                # Passa a servir como seeder reaproveitando o descritor já aberto
+                self.files[torrent_hash] = save_path
+                with self.storages_lock:
+                    self.storages[torrent_hash] = storage
+            self.downloading.pop(torrent_hash, None)
+            if not done:
+                storage.close()
+            # O bitfield só é mantido se faltar algo: é ele que permite retomar depois
+            bitfield.close(remove=download['scheduler'].done)
+        
+        if done:
+            self.metainfo.put(torrent_hash, save_path, file_info)
+            self.piece_index.add(torrent_hash, file_info)
+            log.info("Download concluído: %s", save_path)
             return True
-        else:
-            print(f"Download incompleto: {len(downloaded_pieces)}/{len(pieces)} pedaços")
-            return False
+        missing = len(download['scheduler'].missing)
+        if missing:
+            log.warning("Download incompleto: %d/%d pedaços", len(pieces) - missing, len(pieces))
+        return False
     
-    def send_piece(self, request):
-        """Envia pedaço de arquivo para outro peer"""
+    def _content_hash(self, storage, size):
+        """SHA-1 do arquivo inteiro, lido em blocos (info-hash dos torrents legados)"""
+        digest = hashlib.sha1()
+        for offset in range(0, size, HASH_BLOCK_SIZE):
+            digest.update(storage.read(offset, min(HASH_BLOCK_SIZE, size - offset)))
+        return digest.hexdigest()
+    
+    def _run_download_workers(self, torrent_hash, peers, download):
+        """Mantém um worker por peer e consulta o tracker periodicamente por peers novos.
+
+        Um peer cujo worker saiu (erro, peer lento ou sem pedaços novos) pode voltar
+        depois de PEER_RETRY_INTERVAL, com a espera dobrando a cada saída; depois de
+        PEER_MAX_RETRIES saídas ele fica de fora até o fim do download.
+        """
+        scheduler = download['scheduler']
+        active = {(self.host, self.port)}  # peers com worker rodando (nunca baixa de si mesmo)
+        retries = {}  # peer -> (instante a partir do qual pode voltar, dados do peer, saídas)
+        pending = set()
+        workers = {}  # future -> peer
+        
+        def start_workers(candidates):
+            candidates = list(candidates)
+            random.shuffle(candidates)
+            now = time.monotonic()
+            for peer in candidates:
+                peer_key = (peer['host'], peer['port'])
+                if peer_key in active or len(pending) >= self.max_download_peers:
+                    continue
+                if peer_key in retries and retries[peer_key][0] > now:
+                    continue
+                active.add(peer_key)
+                future = pool.submit(self._download_worker, peer, torrent_hash, download)
+                workers[future] = peer
+                pending.add(future)
+        
+        def backing_off():
+            return any(due < float('inf') for due, _, _ in retries.values())
+        
+        with ThreadPoolExecutor(max_workers=self.max_download_peers) as pool:
+            # Anunciar como leecher torna este peer visível aos demais (e revela outros leechers)
+            start_workers(list(peers) + self._announce_download(torrent_hash))
+            refreshed = time.monotonic()
+            discovered = download['discovered']
+            while (pending or backing_off()) and not scheduler.done:
+                if pending:
+                    finished, _ = wait(pending, timeout=PEX_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                    pending -= finished
+                else:
+                    finished = ()
+                    scheduler.wait_done(PEX_POLL_INTERVAL)  # todos os peers conhecidos estão esperando
+                if scheduler.done:
+                    break
+                for future in finished:
+                    peer = workers[future]
+                    peer_key = (peer['host'], peer['port'])
+                    active.discard(peer_key)
+                    if future.result():
+                        # Parou porque suas cópias do endgame foram canceladas: volta na hora
+                        start_workers([peer])
+                        continue
+                    exits = retries.get(peer_key, (0, None, 0))[2] + 1
+                    delay = PEER_RETRY_INTERVAL * 2 ** (exits - 1) if exits <= PEER_MAX_RETRIES else float('inf')
+                    retries[peer_key] = (time.monotonic() + delay, peer, exits)
+                # Peers cuja espera venceu voltam sem ida ao tracker
+                now = time.monotonic()
+                start_workers([peer for due, peer, _ in retries.values() if due <= now])
+                # Peers trazidos pelo PEX entram sem ida ao tracker
+                running = len(workers)
+                while discovered and len(pending) < self.max_download_peers:
+                    start_workers([discovered.popleft()])
+                if len(workers) > running:
+                    self.metrics.count('pex_workers_started', len(workers) - running)
+                interval = self.peer_refresh_interval
+                if download['pex_active']:
+                    interval *= PEX_REFRESH_FACTOR
+                if (not pending and not backing_off()) or time.monotonic() - refreshed >= interval:
+                    start_workers(self._announce_download(torrent_hash))
+                    refreshed = time.monotonic()
+            # Quem ainda está ocupado só espera cópias já recebidas ou está travado:
+            # fechar a conexão cancela esses pedidos em vez de esperar por eles
+            for future in pending:
+                if not future.done():
+                    self.drop_connection(workers[future], torrent_hash)
+            wait(pending)
+    
+    def _announce_download(self, torrent_hash):
+        """Anuncia como leecher e retorna os peers (seeders e leechers) do torrent"""
+        request = {
+            'action': 'announce',
+            'peer_id': self.peer_id,
+            'torrent_hash': torrent_hash,
+            'host': self.host,
+            'port': self.port,
+            'is_seeder': False
+        }
+        response = self.send_tracker_request(request)
+        if response and response.get('status') == 'success':
+            return response.get('peers', [])
+        return []
+    
+    def _verify_resumed_pieces(self, storage, file_info, marked):
+        """Reconfere os pedaços que o bitfield diz já ter (o disco pode não ter persistido).
+
+        Lê só os pedaços marcados: o custo acompanha o que já foi baixado, não o tamanho do arquivo.
+        """
+        pieces = file_info['pieces']
+        marked = [index for index in marked if index < len(pieces)]
+        if not marked:
+            return set()
+        
+        def check(index):
+            piece_range = storage.piece_range(index)
+            return piece_range is not None and self.verify_piece(file_info, index, storage.read(*piece_range))
+        
+        if sum(pieces[index]['size'] for index in marked) < PARALLEL_HASH_MIN_SIZE:
+            return {index for index in marked if check(index)}
+        # O SHA-1 de blocos grandes libera o GIL: threads bastam para usar todos os núcleos
+        with ThreadPoolExecutor(max_workers=self.hash_workers or os.cpu_count()) as pool:
+            return {index for index, ok in zip(marked, pool.map(check, marked)) if ok}
+    
+    def _copy_local_pieces(self, torrent_hash, file_info, storage, have):
+        """Copia do disco os pedaços que faltam e já existem em outro torrent deste peer.
+
+        Retorna os índices copiados; a economia vai para as métricas `dedup_*`.
+        """
+        copied = set()
+        saved = 0
+        for index, piece in enumerate(file_info['pieces']):
+            if index in have:
+                continue
+            for location in self.piece_index.find(piece['hash'], piece['size']):
+                source_hash, offset = location
+                if source_hash == torrent_hash:
+                    continue
+                try:
+                    data = self.get_storage(source_hash).read(offset, piece['size'])
+                except (KeyError, OSError):
+                    data = b''  # torrent não compartilhado mais ou arquivo inacessível
+                if not self.verify_piece(file_info, index, data):
+                    self.piece_index.discard(piece['hash'], piece['size'], location)
+                    continue
+                storage.write(index * storage.piece_size, data)
+                copied.add(index)
+                saved += len(data)
+                break
+        if copied:
+            self.metrics.count('dedup_pieces', len(copied))
+            self.metrics.count('dedup_bytes', saved)
+            log.info("Dedup: %d/%d pedaços (%d bytes) copiados de arquivos locais",
+                     len(copied), len(file_info['pieces']), saved)
+        return copied
+    
+    def verify_piece(self, file_info, piece_index, piece_data):
+        """Confere tamanho e SHA-1 do pedaço recebido contra os metadados do torrent"""
+        piece_info = file_info['pieces'][piece_index]
+        return (len(piece_data) == piece_info['size'] and
+                hashlib.sha1(piece_data).hexdigest() == piece_info['hash'])
+    
+    def _download_worker(self, peer, torrent_hash, download):
+        """Baixa de um peer os pedaços que o escalonador atribuir a ele.
+
+        Retorna True se parou só porque suas cópias do endgame foram canceladas.
+        """
+        peer_key = (peer['host'], peer['port'])
+        file_info = download['file_info']
+        scheduler = download['scheduler']
+        total_pieces = len(file_info['pieces'])
+        bad_pieces = 0
+        listed = None
+        connection = None
+        try:
+            while connection is None:
+                try:
+                    connection = self.get_connection(peer, torrent_hash)
+                except PeerBusy:
+                    # Seeder lotado: tenta de novo enquanto o download não termina
+                    scheduler.wait_done(CHOKED_RETRY_INTERVAL)
+                    if scheduler.done:
+                        return
+            download['connections'][peer_key] = connection
+            availability, have_seq = self._fetch_bitfield(connection, torrent_hash, total_pieces)
+            scheduler.add_peer(peer_key, availability)
+            complete = availability is None
+            idle_since = None
+            # Enquanto este worker existir, o peer é repassado por PEX a quem perguntar
+            listed = {'peer_id': connection.remote_peer_id or peer['peer_id'], 'host': peer['host'],
+                      'port': peer['port'], 'seeder': complete}
+            self.pex.add(torrent_hash, listed)
+            pex = {'since': None, 'due': float('inf') if connection.legacy else 0}
+            
+            while not scheduler.done:
+                requests = self._piece_requests(torrent_hash, scheduler, peer_key, pex)
+                last_arrival = time.monotonic()
+                choked = False
+                for request, response, piece_data in connection.request_many(requests):
+                    if request['action'] == 'pex':
+                        self._receive_pex(download, pex, response)
+                        continue
+                    piece_index = request['piece_index']
+                    arrival = time.monotonic()
+                    if response.get('choked'):
+                        # Sem vaga de upload no outro peer: o pedaço vai para quem puder enviá-lo
+                        scheduler.release(peer_key, piece_index)
+                        choked = True
+                    elif response.get('status') != 'success':
+                        scheduler.release(peer_key, piece_index, unavailable=True)
+                    elif piece_index not in scheduler.missing:
+                        # Cópia do endgame que chegou depois da primeira: nem confere o hash
+                        scheduler.complete(peer_key, piece_index)
+                        self.metrics.count('duplicate_pieces')
+                    elif not self.verify_piece(file_info, piece_index, piece_data):
+                        # Pedaço corrompido: volta para a fila e é pedido a outro peer
+                        self.metrics.count('hash_failures')
+                        log.warning("Pedaço %d de %s falhou na verificação", piece_index, peer['peer_id'])
+                        scheduler.release(peer_key, piece_index, unavailable=True)
+                        bad_pieces += 1
+                        if bad_pieces >= MAX_BAD_PIECES:
+                            raise ProtocolError(f"{bad_pieces} pedaços corrompidos")
+                    else:
+                        # Grava antes de marcar como concluído: quem vir o pedaço
+                        # como baixado pode lê-lo do disco
+                        storage = download['storage']
+                        storage.write(piece_index * storage.piece_size, piece_data)
+                        self.choker.record_download(connection.remote_peer_id, len(piece_data))
+                        self.metrics.mark('download_bytes', len(piece_data))
+                        # Segurar a leitura do próximo pedaço aplica o limite via controle de fluxo do TCP
+                        self.download_limit.consume(len(piece_data))
+                        connection.download_limit.consume(len(piece_data))
+                        # Com o pipeline cheio, o intervalo entre chegadas mede a vazão do peer
+                        scheduler.record(peer_key, len(piece_data), arrival - last_arrival)
+                        holders = scheduler.complete(peer_key, piece_index)
+                        if holders is not None:
+                            download['bitfield'].set(piece_index)
+                            download['have_log'].append(piece_index)
+                            self.metrics.mark('pieces_downloaded')
+                            log.debug("Baixado pedaço %d/%d de %s",
+                                      piece_index, total_pieces - 1, peer['peer_id'])
+                            if holders:
+                                self._cancel_copies(download, holders)
+                        else:
+                            self.metrics.count('duplicate_pieces')  # cópia do endgame que chegou depois
+                        if scheduler.should_drop(peer_key):
+                            self.metrics.count('slow_peers_dropped')
+                            log.info("Peer %s lento demais (%.0f KiB/s, latência %.2fs); "
+                                     "pedaços devolvidos aos outros",
+                                     peer['peer_id'], scheduler.rate(peer_key) / 1024, connection.latency)
+                            self.drop_connection(peer, torrent_hash)  # respostas ainda em voo ficam para trás
+                            return
+                    last_arrival = arrival
+                
+                if choked:
+                    scheduler.wait_done(CHOKED_RETRY_INTERVAL)
+                    continue
+                if scheduler.wait_for_work(peer_key, None if complete else HAVE_POLL_INTERVAL):
+                    continue
+                if complete:
+                    break
+                
+                # Peer ainda baixando: pergunta quais pedaços ele ganhou desde a última vez
+                new_pieces, have_seq, complete = self._fetch_haves(connection, torrent_hash, have_seq)
+                if complete:
+                    scheduler.set_complete(peer_key)
+                elif new_pieces:
+                    scheduler.add_pieces(peer_key, new_pieces)
+                if complete or new_pieces:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since > PARTIAL_PEER_PATIENCE:
+                    break
+        except Exception as e:
+            self.drop_connection(peer, torrent_hash)
+            if connection is not None and connection.aborted:
+                return True
+            if not scheduler.done:  # depois do fim, erros vêm do cancelamento das cópias do endgame
+                log.warning("Erro ao baixar pedaços do peer %s: %s", peer['peer_id'], e)
+        finally:
+            if connection is not None and download['connections'].get(peer_key) is connection:
+                del download['connections'][peer_key]
+            scheduler.remove_peer(peer_key)
+            if listed is not None:
+                self.pex.drop(torrent_hash, listed)
+    
+    def _cancel_copies(self, download, holders):
+        """Fecha o pipeline dos peers que só esperam cópias de pedaços já concluídos.
+
+        O outro lado atende os pedidos em ordem e não há como retirar um já
+        enviado: fechar a conexão é o que evita transferir as cópias. Quem ainda
+        espera algum pedaço útil fica com a conexão e descarta a cópia ao recebê-la.
+        """
+        scheduler = download['scheduler']
+        for peer_key in holders:
+            connection = download['connections'].get(peer_key)
+            if connection is None or connection.legacy:
+                continue
+            in_flight = [request for request, _ in list(connection.pending)]
+            if in_flight and all(request['action'] == 'get_piece' and
+                                 request['piece_index'] not in scheduler.missing for request in in_flight):
+                self.metrics.count('endgame_cancels', len(in_flight))
+                connection.aborted = True
+                connection.close()
+    
+    def _piece_requests(self, torrent_hash, scheduler, peer_key, pex=None):
+        """Gera pedidos de pedaço sob demanda, conforme o pipeline libera espaço.
+
+        Quando vence o prazo do PEX, um pedido `pex` vai no meio dos pedaços.
+        """
+        while True:
+            if pex is not None and time.monotonic() >= pex['due']:
+                pex['due'] = time.monotonic() + PEX_INTERVAL
+                yield {
+                    'action': 'pex',
+                    'torrent_hash': torrent_hash,
+                    'since': pex['since'],
+                    'peer_id': self.peer_id,
+                    'host': self.host,
+                    'port': self.port,
+                    'seeder': False
+                }
+            piece_index = scheduler.next_piece(peer_key)
+            if piece_index is None:
+                return
+            yield {
+                'action': 'get_piece',
+                'torrent_hash': torrent_hash,
+                'piece_index': piece_index
+            }
+    
+    def _receive_pex(self, download, pex, response):
+        """Guarda a posição do PEX e enfileira os peers novos para o download"""
+        if response.get('status') != 'success':
+            pex['due'] = float('inf')  # peer sem suporte a PEX
+            return
+        download['pex_active'] = True
+        pex['since'] = response.get('pex_seq', pex['since'])
+        pex['due'] = time.monotonic() + max(PEX_INTERVAL, response.get('retry_after', 0))
+        added = [peer for peer in response.get('added', [])[:PEX_MAX_PEERS]
+                 if isinstance(peer, dict) and peer.get('host') and isinstance(peer.get('port'), int)]
+        for peer in added:
+            peer.setdefault('peer_id', f"{peer['host']}:{peer['port']}")
+        if added:
+            self.metrics.count('pex_peers_received', len(added))
+            download['discovered'].extend(added)
+    
+    def _fetch_bitfield(self, connection, torrent_hash, total_pieces):
+        """Pergunta ao peer quais pedaços ele tem.
+
+        Retorna (pedaços ou None se tem todos, posição no log de `have` do peer).
+        """
+        if connection.legacy:
+            return None, 0  # peers antigos só servem arquivos completos
+        response, body = connection.request({'action': 'get_bitfield', 'torrent_hash': torrent_hash})
+        if response.get('status') != 'success':
+            return set(), 0
+        pieces = unpack_bitfield(body, total_pieces)
+        return (None if len(pieces) == total_pieces else pieces), response.get('have_seq', 0)
+    
+    def _fetch_haves(self, connection, torrent_hash, since):
+        """Busca os pedaços que um peer incompleto concluiu desde `since`.
+
+        Retorna (novos pedaços, nova posição, peer completo?).
+        """
+        response, body = connection.request({
+            'action': 'get_have',
+            'torrent_hash': torrent_hash,
+            'since': since
+        })
+        if response.get('status') != 'success':
+            return [], since, False
+        count = len(body) // 4
+        return list(struct.unpack(f'!{count}I', bytes(body))), response.get('have_seq', since), \
+            response.get('complete', False)
+    
+    def send_bitfield(self, request):
+        """Informa quais pedaços deste torrent o peer possui (completo ou ainda baixando)"""
         torrent_hash = request['torrent_hash']
+        download = self.downloading.get(torrent_hash)
+        if download is not None:
+            # Lê a posição do log antes do bitfield: pedaços entre os dois aparecem nos dois
+            have_seq = len(download['have_log'])
+            bitfield = download['bitfield']
+            return {
+                'status': 'success',
+                'piece_count': bitfield.piece_count,
+                'have_seq': have_seq
+            }, bytes(bitfield.bits)
+        
         if torrent_hash not in self.files:
-            return {'status': 'error', 'message': 'Arquivo não encontrado'}
+            return {'status': 'error', 'message': 'Arquivo não encontrado'}, b''
+        
+        try:
+            piece_count = len(self.get_file_info(torrent_hash)['pieces'])
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}, b''
+        return {'status': 'success', 'piece_count': piece_count}, full_bitfield(piece_count)
+    
+    def send_have(self, request):
+        """Pedaços concluídos desde a posição `since` do log (mensagens `have` agregadas)"""
+        torrent_hash = request['torrent_hash']
+        download = self.downloading.get(torrent_hash)
+        if download is None:
+            if torrent_hash in self.files:
+                return {'status': 'success', 'complete': True}, b''
+            return {'status': 'error', 'message': 'Arquivo não encontrado'}, b''
         
+        have_log = download['have_log']
+        have_seq = len(have_log)
+        new_pieces = have_log[request.get('since', 0):have_seq]
+        return {'status': 'success', 'have_seq': have_seq}, struct.pack(f'!{len(new_pieces)}I', *new_pieces)
+    
+    def get_file_info(self, torrent_hash):
+        """Metadados de um torrent deste peer (calculados uma vez se ainda não existirem)"""
+        download = self.downloading.get(torrent_hash)
+        if download is not None:
+            return download['file_info']
+        cached = self.metainfo.get(torrent_hash)
+        if cached is not None:
+            return cached[0]
+        
+        # Arquivo registrado sem passar por add_file (ou modificado)
+        file_path = self.files[torrent_hash]
+        _, file_info = self.hash_file(file_path)
+        self.metainfo.put(torrent_hash, file_path, file_info)
+        return file_info
+    
+    def get_storage(self, torrent_hash):
+        """Retorna o FileStorage do torrent, abrindo o arquivo na primeira vez"""
+        file_path = self.files[torrent_hash]
+        with self.storages_lock:
+            storage = self.storages.get(torrent_hash)
+            if storage is not None and storage.path == file_path:
+                return storage
+        
+        file_info = self.get_file_info(torrent_hash)
+        with self.storages_lock:
+            old = self.storages.get(torrent_hash)
+            if old is not None:
+                old.close()
+                self.piece_cache.discard(torrent_hash)
+            storage = self.storages[torrent_hash] = open_storage(file_path, file_info)
+            return storage
+    
+    def send_piece(self, request):
+        """Envia pedaço de arquivo para outro peer: da memória se for popular, senão direto do disco"""
+        torrent_hash = request['torrent_hash']
         piece_index = request['piece_index']
         
+        download = self.downloading.get(torrent_hash)
+        if download is not None:
+            # Ainda baixando: só serve pedaços já verificados e gravados
+            if not download['bitfield'].has(piece_index):
+                return {'status': 'error', 'message': 'Pedaço não disponível'}, b''
+            return {'status': 'success', 'piece_index': piece_index}, \
+                self._piece_body(torrent_hash, piece_index, download['storage'])
+        
         if torrent_hash not in self.files:
-            return {'status': 'error', 'message': 'Arquivo não encontrado'}
+            return {'status': 'error', 'message': 'Arquivo não encontrado'}, b''
         
-        file_path = self.files[torrent_hash]
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-                pieces = self.split_into_pieces(content)
-                
-                if piece_index < len(pieces):
-                    piece_start = piece_index * 1024
-                    piece_end = min(piece_start + 1024, len(content))
-                    piece_data = content[piece_start:piece_end]
-                    
-                    return {
-                        'status': 'success',
-                        'piece_data': piece_data.decode('latin-1')
-                    }
+            body = self._piece_body(torrent_hash, piece_index, self.get_storage(torrent_hash))
+            if body is not None:
+                return {'status': 'success', 'piece_index': piece_index}, body
         except Exception as e:
-            return {'status': 'error', 'message': str(e)}
+            return {'status': 'error', 'message': str(e)}, b''
         
-        return {'status': 'error', 'message': 'Pedaço não encontrado'}
+        return {'status': 'error', 'message': 'Pedaço não encontrado'}, b''
+    
+    def _piece_body(self, torrent_hash, piece_index, storage):
+        """Bytes do pedaço vindos do cache, ou os trechos do disco (None se o índice não existe)"""
+        piece_range = storage.piece_range(piece_index)
+        if piece_range is None:
+            return None
+        key = (torrent_hash, piece_index)
+        data, admit = self.piece_cache.lookup(key)
+        if data is not None:
+            return data
+        segments = storage.segments(*piece_range)
+        if not admit:
+            return segments
+        # Segundo pedido recente: lê uma vez para a memória e os próximos não vão ao disco
+        data = segments.read()
+        self.piece_cache.put(key, data)
+        return data
     
     def send_file_info(self, request):
-        """Envia informações do arquivo"""
+        """Envia informações do arquivo (JSON no corpo do quadro)"""
         torrent_hash = request['torrent_hash']
         
+        download = self.downloading.get(torrent_hash)
+        if download is not None:
+            return {'status': 'success'}, download['encoded_info']
+        
         if torrent_hash not in self.files:
-            return {'status': 'error', 'message': 'Arquivo não encontrado'}
+            return {'status': 'error', 'message': 'Arquivo não encontrado'}, b''
+        
+        cached = self.metainfo.get(torrent_hash)
+        if cached is not None:
+            return {'status': 'success'}, cached[1]
         
-        file_path = self.files[torrent_hash]
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-                file_info = {
-                    'name': os.path.basename(file_path),
-                    'size': len(content),
-                    'pieces': self.split_into_pieces(content)
-                }
-                return {'status': 'success', 'file_info': file_info}
+            file_info = self.get_file_info(torrent_hash)
+            return {'status': 'success'}, json.dumps(file_info).encode('utf-8')
         except Exception as e:
-            return {'status': 'error', 'message': str(e)}
+            return {'status': 'error', 'message': str(e)}, b''
             
     def interactive_menu(self):
         """Menu interativo para o peer"""
         print("\n=== MENU DO PEER ===")
         print("Comandos disponíveis:")
         print("  refresh - Atualizar lista de torrents")
-        print("  share <arquivo> - Compartilhar arquivo")
+        print("  share <arquivo|diretório> - Compartilhar arquivo ou diretório (um torrent)")
         print("  download <hash> <destino> - Baixar arquivo")
+        print("  stats - Métricas do peer")
         print("  exit - Sair")
     
         while True:
@@ -339,7 +2521,7 @@ class Peer:
             elif parts[0] == "share" and len(parts) == 2:
                 file_path = parts[1]
                 if not os.path.exists(file_path):
-                    print(f"Erro: Arquivo '{file_path}' não encontrado.")
+                    print(f"Erro: '{file_path}' não encontrado.")
                     continue
                 torrent_hash = self.add_file(file_path)
                 if torrent_hash:
@@ -356,22 +2538,35 @@ class Peer:
                 for torrent_hash, file_path in self.files.items():
                     print(f"  - {file_path} (Hash: {torrent_hash})")
         
+            elif parts[0] == "stats":
+                print(self.metrics.exposition())
+        
             elif parts[0] == "exit":
                 print("Encerrando peer...")
                 os._exit(0)
         
             else:
                 print("Comando inválido. Use:")
-                print("  share <caminho_arquivo>")
+                print("  share <caminho_arquivo_ou_diretório>")
                 print("  download <hash> <saida>")
                 print("  list")
+                print("  stats")
                 print("  refresh")
                 print("  exit")
             
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Peer do MiniBitTorrent")
+    parser.add_argument('--log-level', default='INFO',
+                        help='Nível dos logs (DEBUG mostra cada pedaço baixado; custa caro sob carga)')
+    parser.add_argument('--cache-mb', type=float, default=PIECE_CACHE_SIZE / (1024 * 1024),
+                        help='Memória para pedaços populares servidos a outros peers (0 desliga)')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    
     peer_id = input("Digite um ID para este peer: ").strip() or f"peer_{random.randint(1000, 9999)}"
     port = int(input("Digite a porta para este peer (ex: 9001): ") or random.randint(9000, 9999))
     
     peer = Peer(peer_id=peer_id, port=port)
+    peer.piece_cache.budget = int(args.cache_mb * 1024 * 1024)
     threading.Thread(target=peer.interactive_menu, daemon=True).start()
     peer.start()  # Inicia o servidor
\ No newline at end of file
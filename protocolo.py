@@ -0,0 +1,308 @@
+# protocolo.py - Enquadramento binário compartilhado entre peers e tracker
+import json
+import os
+import select
+import socket
+import struct
+import threading
+
+# Cada quadro começa com: magic (4 bytes), tamanho do cabeçalho JSON e tamanho do corpo binário
+MAGIC = b'MBT1'
+FRAME_PREFIX = struct.Struct('!4sII')
+MAX_HEADER_SIZE = 1024 * 1024          # cabeçalhos são pequenos (ação, índices, status)
+MAX_BODY_SIZE = 256 * 1024 * 1024      # corpo carrega pedaços ou metadados
+
+# Listas compactas de peers do tracker: registros de tamanho fixo (endereço + porta)
+COMPACT_PEER4 = struct.Struct('!4sH')
+COMPACT_PEER6 = struct.Struct('!16sH')
+
+# Anúncios por UDP: um datagrama por pedido, sem o custo de abrir e fechar uma conexão TCP.
+# O cliente primeiro troca UDP_PROTOCOL_ID por um connection_id ligado ao seu endereço,
+# o que impede que um endereço forjado receba respostas ou injete anúncios.
+UDP_PROTOCOL_ID = 0x4D42545544503031   # "MBTUDP01", usado no lugar do connection_id no connect
+UDP_REQUEST = struct.Struct('!QII')     # connection_id, ação, transação (+ campos JSON)
+UDP_RESPONSE = struct.Struct('!II')     # ação, transação (+ quadro MBT1 ou connection_id)
+UDP_CONNECTION = struct.Struct('!Q')
+UDP_CONNECT, UDP_ANNOUNCE, UDP_GET_PEERS, UDP_ERROR = range(4)
+UDP_ACTIONS = {UDP_ANNOUNCE: 'announce', UDP_GET_PEERS: 'get_peers'}
+MAX_DATAGRAM_SIZE = 65507
+
+
+_seek_lock = threading.Lock()  # só usado onde não existe os.pread (Windows)
+
+
+class ProtocolError(Exception):
+    """Quadro malformado ou conexão encerrada no meio de uma mensagem"""
+
+
+class FileSegments(list):
+    """Corpo de quadro servido direto do disco: lista de (fd, offset, tamanho)"""
+    
+    @property
+    def size(self):
+        return sum(count for _, _, count in self)
+    
+    def read(self):
+        """Lê os trechos para a memória (usado apenas no protocolo JSON legado)"""
+        return b''.join(read_at(fd, offset, count) for fd, offset, count in self)
+
+
+def read_at(fd, offset, count):
+    """Lê `count` bytes a partir de `offset` sem depender da posição do descritor"""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, count, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, count)
+
+
+def write_at(fd, offset, data):
+    """Grava `data` a partir de `offset` sem depender da posição do descritor"""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+def send_file_segment(sock, fd, offset, count):
+    """Envia um trecho do arquivo pelo socket sem copiá-lo para o Python (sendfile)"""
+    if hasattr(os, 'sendfile'):
+        timeout = sock.gettimeout()
+        while count > 0:
+            try:
+                sent = os.sendfile(sock.fileno(), fd, offset, count)
+            except BlockingIOError:
+                # Sockets com timeout ficam não bloqueantes no nível do SO
+                _, writable, _ = select.select([], [sock], [], timeout)
+                if not writable:
+                    raise socket.timeout('timed out')
+                continue
+            if sent == 0:
+                raise ProtocolError("Arquivo terminou antes do trecho solicitado")
+            offset += sent
+            count -= sent
+        return
+    
+    while count > 0:
+        chunk = read_at(fd, offset, min(count, 1024 * 1024))
+        if not chunk:
+            raise ProtocolError("Arquivo terminou antes do trecho solicitado")
+        sock.sendall(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+def recv_exact(sock, size):
+    """Lê exatamente `size` bytes do socket (ou falha se a conexão fechar antes)"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ProtocolError(f"Conexão encerrada após {received}/{size} bytes")
+        received += n
+    return buffer
+
+
+def pack_frame(header, body_size=0):
+    """Monta o prefixo + cabeçalho de um quadro cujo corpo tem `body_size` bytes"""
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return FRAME_PREFIX.pack(MAGIC, len(header_bytes), body_size) + header_bytes
+
+
+def send_frame(sock, header, body=b''):
+    """Envia um quadro completo (cabeçalho JSON + corpo binário bruto ou FileSegments).
+
+    Retorna o número de bytes enviados.
+    """
+    if isinstance(body, FileSegments):
+        prefix = pack_frame(header, body.size)
+        sock.sendall(prefix)
+        for fd, offset, count in body:
+            send_file_segment(sock, fd, offset, count)
+        return len(prefix) + body.size
+    
+    prefix = pack_frame(header, len(body))
+    if len(body) <= 65536:
+        # Uma única chamada evita um segmento TCP extra para pedaços pequenos
+        sock.sendall(prefix + bytes(body))
+    else:
+        sock.sendall(prefix)
+        sock.sendall(body)
+    return len(prefix) + len(body)
+
+
+def recv_frame(sock, magic=None, with_size=False):
+    """Lê um quadro do socket e retorna (cabeçalho, corpo).
+
+    Retorna None se a conexão foi fechada limpa antes do início do quadro.
+    `magic` permite passar os 4 bytes iniciais já lidos (ex.: ao detectar o modo).
+    Com `with_size` retorna também o tamanho do quadro no fio.
+    """
+    if magic is None:
+        magic = sock.recv(len(MAGIC))
+        if not magic:
+            return None
+    prefix = bytes(magic) + bytes(recv_exact(sock, FRAME_PREFIX.size - len(magic)))
+
+    tag, header_size, body_size = FRAME_PREFIX.unpack(prefix)
+    if tag != MAGIC:
+        raise ProtocolError("Quadro com magic inválido")
+    if header_size > MAX_HEADER_SIZE or body_size > MAX_BODY_SIZE:
+        raise ProtocolError(f"Quadro grande demais ({header_size}/{body_size} bytes)")
+
+    header = json.loads(bytes(recv_exact(sock, header_size)).decode('utf-8'))
+    body = recv_exact(sock, body_size) if body_size else b''
+    if with_size:
+        return header, body, FRAME_PREFIX.size + header_size + body_size
+    return header, body
+
+
+def unpack_frame(buffer):
+    """Extrai um quadro do início de `buffer` (para leitores não bloqueantes).
+
+    Retorna (cabeçalho, corpo, bytes consumidos) ou None se o quadro ainda está incompleto.
+    """
+    if len(buffer) < FRAME_PREFIX.size:
+        return None
+    tag, header_size, body_size = FRAME_PREFIX.unpack_from(buffer)
+    if tag != MAGIC:
+        raise ProtocolError("Quadro com magic inválido")
+    if header_size > MAX_HEADER_SIZE or body_size > MAX_BODY_SIZE:
+        raise ProtocolError(f"Quadro grande demais ({header_size}/{body_size} bytes)")
+    end = FRAME_PREFIX.size + header_size + body_size
+    if len(buffer) < end:
+        return None
+    header = json.loads(bytes(buffer[FRAME_PREFIX.size:FRAME_PREFIX.size + header_size]).decode('utf-8'))
+    return header, bytes(buffer[end - body_size:end]), end
+
+
+def recv_json(sock, initial=b'', with_size=False):
+    """Lê uma mensagem JSON legada (sem enquadramento) até que ela esteja completa"""
+    decoder = json.JSONDecoder()
+    data = bytes(initial)
+    while True:
+        if data:
+            try:
+                text = data.decode('utf-8')
+                message, _ = decoder.raw_decode(text.lstrip())
+                return (message, len(data)) if with_size else message
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                if len(data) > MAX_HEADER_SIZE + MAX_BODY_SIZE:
+                    raise ProtocolError("Mensagem JSON grande demais")
+        chunk = sock.recv(65536)
+        if not chunk:
+            if data:
+                raise ProtocolError("Mensagem JSON incompleta")
+            return None
+        data += chunk
+
+
+def pack_bitfield(indices, count):
+    """Codifica o conjunto de pedaços `indices` (de `count` no total) em 1 bit por pedaço"""
+    bitfield = bytearray((count + 7) // 8)
+    for index in indices:
+        bitfield[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitfield)
+
+
+def full_bitfield(count):
+    """Bitfield de quem tem todos os pedaços (seeder)"""
+    full, rest = divmod(count, 8)
+    return b'\xff' * full + (bytes([(0xff00 >> rest) & 0xff]) if rest else b'')
+
+
+def unpack_bitfield(bitfield, count):
+    """Decodifica um bitfield no conjunto de índices de pedaços presentes"""
+    indices = set()
+    for byte_index, byte in enumerate(bytes(bitfield[:(count + 7) // 8])):
+        if byte:
+            base = byte_index << 3
+            indices.update(base + bit for bit in range(8) if byte & (0x80 >> bit) and base + bit < count)
+    return indices
+
+
+def pack_host(host):
+    """Endereço IP empacotado (4 ou 16 bytes) de `host`, ou None se não resolver"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, host)
+        except OSError:
+            pass
+    try:
+        return socket.inet_aton(socket.gethostbyname(host))
+    except OSError:
+        return None
+
+
+def pack_peers(addresses):
+    """Codifica [(ip_empacotado, porta)] como registros IPv4 seguidos dos IPv6.
+
+    Retorna (quantidade IPv4, quantidade IPv6, corpo).
+    """
+    peers4 = [COMPACT_PEER4.pack(ip, port) for ip, port in addresses if len(ip) == 4]
+    peers6 = [COMPACT_PEER6.pack(ip, port) for ip, port in addresses if len(ip) == 16]
+    return len(peers4), len(peers6), b''.join(peers4 + peers6)
+
+
+def unpack_peers(body, count4, count6):
+    """Decodifica o corpo de `pack_peers` em [(host, porta)]"""
+    peers = []
+    offset = 0
+    for record, family, count in ((COMPACT_PEER4, socket.AF_INET, count4), (COMPACT_PEER6, socket.AF_INET6, count6)):
+        for ip, port in record.iter_unpack(bytes(body[offset:offset + record.size * count])):
+            peers.append((socket.inet_ntop(family, ip), port))
+        offset += record.size * count
+    return peers
+
+
+def pack_udp_request(connection_id, action, transaction_id, fields=None):
+    """Datagrama de pedido: prefixo binário seguido dos campos do pedido em JSON"""
+    payload = json.dumps(fields, separators=(',', ':')).encode('utf-8') if fields else b''
+    return UDP_REQUEST.pack(connection_id, action, transaction_id) + payload
+
+
+def unpack_udp_request(datagram):
+    """Retorna (connection_id, ação, transação, campos) de um datagrama de pedido"""
+    if len(datagram) < UDP_REQUEST.size:
+        raise ProtocolError("Datagrama curto demais")
+    connection_id, action, transaction_id = UDP_REQUEST.unpack_from(datagram)
+    payload = bytes(datagram[UDP_REQUEST.size:])
+    try:
+        fields = json.loads(payload.decode('utf-8')) if payload else {}
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ProtocolError("Campos do datagrama não são JSON válido")
+    if not isinstance(fields, dict):
+        raise ProtocolError("Campos do datagrama não são um objeto JSON")
+    return connection_id, action, transaction_id, fields
+
+
+def pack_udp_response(action, transaction_id, header, body=b''):
+    """Datagrama de resposta: ação e transação seguidas de um quadro MBT1 completo"""
+    return UDP_RESPONSE.pack(action, transaction_id) + pack_frame(header, len(body)) + body
+
+
+def unpack_udp_response(datagram):
+    """Retorna (ação, transação, carga): connection_id no connect, (cabeçalho, corpo) nos demais"""
+    if len(datagram) < UDP_RESPONSE.size:
+        raise ProtocolError("Datagrama curto demais")
+    action, transaction_id = UDP_RESPONSE.unpack_from(datagram)
+    payload = datagram[UDP_RESPONSE.size:]
+    if action == UDP_CONNECT:
+        if len(payload) != UDP_CONNECTION.size:
+            raise ProtocolError("Resposta de connect malformada")
+        return action, transaction_id, UDP_CONNECTION.unpack(payload)[0]
+    message = unpack_frame(payload)
+    if message is None:
+        raise ProtocolError("Datagrama com quadro incompleto")
+    header, body, _ = message
+    return action, transaction_id, (header, body)
@@ -5,7 +5,7 @@ param(
 
 # Create fresh peer VM directory
 New-Item -ItemType Directory -Path ".\peer_$peerId" -Force
-Copy-Item "peer.py" -Destination ".\peer_$peerId"
+Copy-Item "peer.py", "protocolo.py", "metricas.py" -Destination ".\peer_$peerId"
 
 $vagrantContent = @"
 Vagrant.configure("2") do |config|
@@ -1,5 +1,5 @@
 # Create fresh tracker VM
-$trackerFiles = @("tracker.py", "README.md")  # Only essential files
+$trackerFiles = @("tracker.py", "protocolo.py", "metricas.py", "README.md")  # Only essential files
 
 # Create temp directory with just tracker files
 New-Item -ItemType Directory -Path .\tracker_vm -Force
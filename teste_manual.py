@@ -3,6 +3,7 @@ import time
 import os
 from tracker import Tracker
 from peer import Peer
+from metricas import configure_logging
 
 def teste_passo_a_passo():
     """Teste manual para entender cada etapa"""
@@ -175,6 +176,7 @@ def teste_multiplos_peers():
 
 def main():
     """Executa todos os testes"""
+    configure_logging('INFO')  # mostra os eventos do tracker e dos peers junto com os passos
     # Teste básico
     seeder, downloader, hash1 = teste_passo_a_passo()
     
@@ -1,25 +1,589 @@
 # tracker.py - Servidor central que gerencia peers e torrents
+import argparse
+import asyncio
+import logging
+import multiprocessing
 import socket
+import tempfile
 import threading
 import json
 import hashlib
 import time
 import os
+import random
+import zlib
+from itertools import islice
 from typing import Dict, List, Set
 
+from protocolo import (FRAME_PREFIX, MAGIC, MAX_DATAGRAM_SIZE, MAX_HEADER_SIZE, UDP_ACTIONS, UDP_CONNECT,
+                       UDP_CONNECTION, UDP_ERROR, UDP_PROTOCOL_ID, UDP_RESPONSE, ProtocolError, pack_frame,
+                       pack_host, pack_peers, pack_udp_response, recv_exact, recv_frame, recv_json, send_frame,
+                       unpack_frame, unpack_udp_request)
+from metricas import Metrics, configure_logging
+
+CLIENT_IDLE_TIMEOUT = 30  # segundos de silêncio até o tracker fechar a conexão do cliente
+PEER_TTL = 1800           # segundos sem anunciar até o peer sair do torrent
+REAP_INTERVAL = 10        # granularidade (s) da roda de expiração
+DEFAULT_NUMWANT = 50      # peers devolvidos por announce/get_peers quando o pedido não diz
+MAX_NUMWANT = 200
+WAL_FLUSH_INTERVAL = 1.0  # segundos entre gravações em lote do log em disco
+SNAPSHOT_EVERY = 200000   # linhas de log acumuladas que disparam uma nova snapshot
+SNAPSHOT_CHUNK = 5000     # peers codificados por vez na snapshot (o codificador em C segura o GIL)
+ALL_SHARDS = -1           # destino de pedidos que envolvem vários shards (listas e lotes)
+UDP_CONNECTION_WINDOW = 60  # segundos; um connection_id vale na janela em que saiu e na seguinte
+UDP_ACTION_CODES = {name: code for code, name in UDP_ACTIONS.items()}
+ACTIONS = ('list_torrents', 'announce', 'announce_batch', 'get_peers', 'register_torrent', 'stats')
+
+log = logging.getLogger('tracker')
+
+
+def shard_of(torrent_hash, shard_count):
+    """Shard dono do torrent (crc32 é estável entre processos, ao contrário de hash())"""
+    return zlib.crc32(torrent_hash.encode('utf-8')) % shard_count
+
+
+class PeerSet:
+    """Conjunto de peer_ids com inserção e remoção O(1) e acesso por posição.
+
+    Os itens ficam numa lista (para sortear amostras por índice) e o dicionário
+    guarda a posição de cada um; a remoção move o último item para o buraco.
+    """
+    
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.positions = dict(zip(self.items, range(len(self.items))))
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __contains__(self, item):
+        return item in self.positions
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+    
+    def discard(self, item):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+
+class ExpiryWheel:
+    """Roda de expiração: chaves agrupadas em baldes de `interval` segundos.
+
+    Renovar ou remover uma chave custa O(1); `expire` esvazia apenas os baldes
+    já vencidos, então cada chave é visitada uma única vez ao expirar.
+    """
+    
+    def __init__(self, interval, now=None):
+        self.interval = interval
+        self.buckets: Dict[int, Set] = {}  # número do balde -> chaves
+        self.slot_of = {}                  # chave -> número do balde
+        self.next_slot = int((now or time.time()) // interval)
+    
+    def __len__(self):
+        return len(self.slot_of)
+    
+    def touch(self, key, deadline):
+        """Agenda (ou reagenda) a expiração de `key` para `deadline`"""
+        self.discard(key)
+        # Arredonda para cima: a chave nunca expira antes do prazo
+        slot = max(int(deadline // self.interval) + 1, self.next_slot)
+        self.buckets.setdefault(slot, set()).add(key)
+        self.slot_of[key] = slot
+    
+    def load(self, entries):
+        """Agenda em lote pares (chave, prazo) de chaves ainda não presentes na roda"""
+        interval, floor = self.interval, self.next_slot
+        for key, deadline in entries:
+            slot = max(int(deadline // interval) + 1, floor)
+            bucket = self.buckets.get(slot)
+            if bucket is None:
+                bucket = self.buckets[slot] = set()
+            bucket.add(key)
+            self.slot_of[key] = slot
+    
+    def discard(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            bucket = self.buckets[slot]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[slot]
+    
+    def expire(self, now):
+        """Remove e retorna as chaves cujo prazo já passou"""
+        expired = []
+        current = int(now // self.interval)
+        while self.next_slot <= current:
+            for key in self.buckets.pop(self.next_slot, ()):
+                del self.slot_of[key]
+                expired.append(key)
+            self.next_slot += 1
+        return expired
+
+
+class TrackerJournal:
+    """Persistência do tracker: log de escrita antecipada (WAL) e snapshots compactadas.
+
+    Cada registro de torrent e cada anúncio vira uma linha JSON acumulada em memória;
+    uma thread grava o lote (com fsync) a cada WAL_FLUSH_INTERVAL, então o pedido só
+    paga um append em lista. Depois de SNAPSHOT_EVERY linhas, o estado vivo é gravado
+    em `snapshot.json` e os logs cobertos por ela são apagados. A snapshot só segura
+    o lock do tracker para trocar de log e copiar referências do estado; serializar
+    (em pedaços, para não segurar o GIL), gravar e o fsync acontecem fora dele.
+    """
+    
+    SNAPSHOT = 'snapshot.json'
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.pending = []        # linhas ainda não gravadas
+        self.pending_lock = threading.Lock()
+        self.write_lock = threading.Lock()  # um lote ou uma troca de log por vez (menu x thread de gravação)
+        self.records = 0         # linhas desde a última snapshot
+        self.sequence = 0        # número do log aberto para escrita
+        self.log = None
+    
+    def _log_path(self, sequence):
+        return os.path.join(self.directory, f"wal.{sequence:08d}.log")
+    
+    def _log_sequences(self):
+        return sorted(int(name.split('.')[1]) for name in os.listdir(self.directory)
+                      if name.startswith('wal.') and name.endswith('.log'))
+    
+    def restore(self, tracker):
+        """Recarrega a snapshot e os logs seguintes no tracker e abre um log novo"""
+        covered = 0
+        path = os.path.join(self.directory, self.SNAPSHOT)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            covered = snapshot['log_seq']
+            tracker._import_state(snapshot)
+        
+        sequences = self._log_sequences()
+        for sequence in sequences:
+            if sequence < covered:
+                os.remove(self._log_path(sequence))  # sobra de uma compactação interrompida
+                continue
+            with open(self._log_path(sequence), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # última linha cortada por uma queda
+                    self._apply(tracker, record)
+                    self.records += 1
+        
+        self.sequence = max(sequences[-1] + 1 if sequences else 0, covered)
+        self.log = open(self._log_path(self.sequence), 'a', encoding='utf-8')
+    
+    def _apply(self, tracker, record):
+        kind = record[0]
+        if kind == 'R':
+            tracker._register(record[1], record[2])
+        elif kind == 'A' and record[1] in tracker.torrents:
+            tracker._announce(*record[1:])
+    
+    def append(self, record):
+        # Só guarda o registro: a serialização fica para a thread de gravação
+        with self.pending_lock:
+            self.pending.append(record)
+            self.records += 1
+    
+    def flush(self):
+        """Grava no disco os registros acumulados"""
+        with self.write_lock:
+            with self.pending_lock:
+                records, self.pending = self.pending, []
+            self._write(self.log, records)
+    
+    def _write(self, log_file, records):
+        if records:
+            log_file.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+            log_file.flush()
+            os.fsync(log_file.fileno())
+    
+    def snapshot(self, tracker):
+        """Grava o estado vivo e descarta os logs que ele cobre"""
+        with self.write_lock:
+            new_log = open(self._log_path(self.sequence + 1), 'a', encoding='utf-8')
+            with tracker.lock:
+                # Ponto de corte: o que já foi aplicado está na cópia, o que vier depois vai para o log novo
+                with self.pending_lock:
+                    records, self.pending = self.pending, []
+                    self.records = 0
+                old_log, self.log = self.log, new_log
+                self.sequence += 1
+                state = tracker._copy_state()
+            # O log antigo recebe o resto do lote: vale até a snapshot chegar ao disco
+            self._write(old_log, records)
+            old_log.close()
+        
+        path = os.path.join(self.directory, self.SNAPSHOT)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for chunk in tracker._export_state(state, self.sequence):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for sequence in self._log_sequences():
+            if sequence < self.sequence:
+                os.remove(self._log_path(sequence))
+    
+    def run(self, tracker):
+        """Laço da thread de gravação: lotes a cada WAL_FLUSH_INTERVAL e snapshots periódicas"""
+        while True:
+            time.sleep(WAL_FLUSH_INTERVAL)
+            try:
+                self.flush()
+                if self.records >= SNAPSHOT_EVERY:
+                    self.snapshot(tracker)
+            except OSError as e:
+                log.error("Erro ao gravar o estado do tracker: %s", e)
+
+
+class TrackerProtocol(asyncio.Protocol):
+    """Conexão atendida pelo laço de eventos.
+
+    Clientes JSON enviam um pedido e recebem a resposta antes do fechamento;
+    clientes com quadros binários (detectados pelo magic) podem mandar vários
+    pedidos pela mesma conexão.
+    """
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.transport = None
+        self.buffer = bytearray()
+        self.framed = None  # None até os primeiros bytes revelarem o formato
+        self.timeout = None
+        self.last_reply = None  # resposta ainda em preparo (pedido encaminhado a outro shard)
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self._reset_timeout()
+        self.tracker.metrics.count('connections_opened')
+        log.debug("Nova conexão de %s", self.addr)
+    
+    def _reset_timeout(self):
+        if self.timeout:
+            self.timeout.cancel()
+        self.timeout = asyncio.get_event_loop().call_later(CLIENT_IDLE_TIMEOUT, self.transport.close)
+    
+    def data_received(self, data):
+        self.tracker.metrics.count('bytes_received', len(data), transport='tcp')
+        self.buffer += data
+        if self.framed is None:
+            if len(self.buffer) < len(MAGIC) and MAGIC.startswith(self.buffer):
+                return
+            self.framed = self.buffer.startswith(MAGIC)
+        try:
+            if self.framed:
+                self._handle_frames()
+            else:
+                self._handle_json()
+        except Exception as e:
+            log.warning("Erro com %s: %s", self.addr, e)
+            self.transport.close()
+    
+    def _handle_frames(self):
+        self._reset_timeout()
+        message = unpack_frame(self.buffer)
+        while message is not None:
+            request, _, consumed = message
+            del self.buffer[:consumed]
+            log.debug("Pedido de %s: %s", self.addr, request)
+            self._respond(request, self._send_frame)
+            message = unpack_frame(self.buffer)
+    
+    def _send_frame(self, request, response, body):
+        if 'id' in request:
+            response['id'] = request['id']
+        data = pack_frame(response, len(body)) + body
+        self.tracker.metrics.count('bytes_sent', len(data), transport='tcp')
+        self.transport.write(data)
+    
+    def _send_json(self, request, response, body):
+        data = json.dumps(response).encode('utf-8')
+        self.tracker.metrics.count('bytes_sent', len(data), transport='tcp')
+        self.transport.write(data)
+        self.transport.close()
+    
+    def _respond(self, request, send):
+        """Responde já, ou depois que o shard dono do torrent responder.
+
+        As respostas saem na ordem dos pedidos: enquanto um encaminhamento está
+        pendente, os pedidos seguintes esperam por ele.
+        """
+        shard = self.tracker.shard_for(request)
+        if shard is None and (self.last_reply is None or self.last_reply.done()):
+            send(request, *self.tracker.process_request(request))
+            return
+        self.last_reply = asyncio.ensure_future(self._respond_later(request, shard, send, self.last_reply))
+    
+    async def _respond_later(self, request, shard, send, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            if shard is None:
+                response, body = self.tracker.process_request(request)
+            else:
+                response, body = await self.tracker.router.forward(request, shard)
+        except Exception as e:
+            log.warning("Erro ao encaminhar pedido de %s: %s", self.addr, e)
+            response, body = {'status': 'error', 'message': 'Shard indisponível'}, b''
+        if not self.transport.is_closing():
+            send(request, response, body)
+    
+    def _handle_json(self):
+        try:
+            request, _ = json.JSONDecoder().raw_decode(self.buffer.decode('utf-8').lstrip())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ProtocolError("pedido grande demais")
+            return  # pedido ainda incompleto
+        
+        log.debug("Pedido de %s: %s", self.addr, request)
+        request.pop('compact', None)  # a lista compacta só existe com quadros binários
+        self._respond(request, self._send_json)
+    
+    def connection_lost(self, exc):
+        self.tracker.metrics.count('connections_closed')
+        if self.timeout:
+            self.timeout.cancel()
+
+
+class TrackerDatagramProtocol(asyncio.DatagramProtocol):
+    """Anúncios UDP atendidos pelo laço de eventos.
+
+    Sem conexão não há ordem a preservar: pedidos de torrents de outro shard são
+    encaminhados e respondidos quando o dono responder. Datagramas perdidos ou
+    descartados ficam por conta da retransmissão do cliente.
+    """
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.transport = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def datagram_received(self, data, addr):
+        self.tracker.metrics.count('bytes_received', len(data), transport='udp')
+        try:
+            transaction_id, request, reply = self.tracker.parse_datagram(data, addr)
+            if request is None:
+                self._send(reply, addr)
+                return
+            shard = self.tracker.shard_for(request)
+            if shard is None:
+                response, body = self.tracker.process_request(request)
+                self._send(self.tracker.udp_reply(transaction_id, request, response, body), addr)
+            else:
+                asyncio.ensure_future(self._forward(transaction_id, request, shard, addr))
+        except Exception as e:
+            self.tracker.metrics.count('datagrams_dropped')
+            log.debug("Datagrama descartado de %s: %s", addr, e)
+    
+    def _send(self, reply, addr):
+        self.tracker.metrics.count('bytes_sent', len(reply), transport='udp')
+        self.transport.sendto(reply, addr)
+    
+    async def _forward(self, transaction_id, request, shard, addr):
+        try:
+            response, body = await self.tracker.router.forward(request, shard)
+        except Exception as e:
+            log.warning("Erro ao encaminhar datagrama de %s: %s", addr, e)
+            return
+        self._send(self.tracker.udp_reply(transaction_id, request, response, body), addr)
+
+
+class ShardRouter:
+    """Encaminha pedidos aos outros shards por conexões Unix persistentes (quadros MBT1).
+
+    Cada shard mantém uma conexão com cada um dos outros; as respostas voltam
+    casadas pelo `id` do pedido, então vários encaminhamentos podem estar em voo.
+    """
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.links = {}    # shard -> tarefa que abre a conexão (StreamWriter)
+        self.waiting = {}  # id -> (shard, future da resposta)
+        self.next_id = 0
+    
+    async def _connect(self, shard):
+        reader, writer = await asyncio.open_unix_connection(self.tracker.shard_paths[shard])
+        asyncio.ensure_future(self._read_responses(shard, reader))
+        return writer
+    
+    async def _read_responses(self, shard, reader):
+        try:
+            while True:
+                prefix = await reader.readexactly(FRAME_PREFIX.size)
+                _, header_size, body_size = FRAME_PREFIX.unpack(prefix)
+                response = json.loads(await reader.readexactly(header_size))
+                body = await reader.readexactly(body_size) if body_size else b''
+                _, future = self.waiting.pop(response.pop('id', None), (None, None))
+                if future is not None and not future.done():
+                    future.set_result((response, body))
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # Conexão perdida: a próxima chamada reconecta; os pedidos em voo falham
+            self.links.pop(shard, None)
+            for request_id, (owner, future) in list(self.waiting.items()):
+                if owner == shard:
+                    del self.waiting[request_id]
+                    future.set_exception(ProtocolError(f"Shard {shard} desconectado: {e}"))
+    
+    async def request(self, shard, request):
+        if shard not in self.links:
+            self.links[shard] = asyncio.ensure_future(self._connect(shard))
+        try:
+            writer = await self.links[shard]
+        except OSError:
+            self.links.pop(shard, None)
+            raise
+        self.next_id += 1
+        self.tracker.metrics.count('forwarded', shard=shard)
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[self.next_id] = (shard, future)
+        writer.write(pack_frame(dict(request, id=self.next_id)))
+        return await future
+    
+    async def forward(self, request, shard):
+        """Encaminha ao shard dono; `ALL_SHARDS` junta o `list_torrents` de todos ou divide um lote"""
+        if shard != ALL_SHARDS:
+            return await self.request(shard, request)
+        if request['action'] == 'announce_batch':
+            return await self._forward_batch(request)
+        others = [index for index in range(self.tracker.shard_count) if index != self.tracker.shard_index]
+        replies = await asyncio.gather(*(self.request(index, dict(request, local=True)) for index in others))
+        response, _ = self.tracker.process_request(request)
+        for reply, _ in replies:
+            response['torrents'].extend(reply.get('torrents', []))
+        return response, b''
+    
+    async def _forward_batch(self, request):
+        """Cada shard anuncia a sua parte do lote; as respostas são somadas"""
+        parts = {}
+        for entry in request['torrents']:
+            parts.setdefault(shard_of(entry['torrent_hash'], self.tracker.shard_count), []).append(entry)
+        own = parts.pop(self.tracker.shard_index, [])
+        replies = await asyncio.gather(*(self.request(index, dict(request, torrents=part, local=True))
+                                         for index, part in parts.items()))
+        response, _ = self.tracker.process_request(dict(request, torrents=own))
+        for reply, _ in replies:
+            if reply.get('status') != 'success':
+                return reply, b''
+            response['announced'] += reply['announced']
+            response['unknown'].extend(reply['unknown'])
+        return response, b''
+
+
 class Tracker:
-    def __init__(self, host='localhost', port=8000):
+    def __init__(self, host='localhost', port=8000, backlog=1024, state_dir=None,
+                 shard_index=0, shard_paths=None, udp=True, udp_secret=None):
         self.host = host
         self.port = port
-        self.torrents: Dict[str, Dict] = {}  # hash -> {peers: set, file_info: dict}
-        self.peers: Dict[str, Dict] = {}     # peer_id -> {host, port, last_seen}
-        
-    def start(self):
+        self.backlog = backlog  # limitado pelo SO (net.core.somaxconn no Linux)
+        self.torrents: Dict[str, Dict] = {}  # hash -> {seeders: PeerSet, leechers: PeerSet, file_info: dict}
+        self.peers: Dict[str, Dict] = {}     # peer_id -> {host, port, last_seen, torrents: set}
+        self.expiry = ExpiryWheel(REAP_INTERVAL)  # (hash, peer_id) -> prazo do último anúncio
+        self.lock = threading.Lock()  # handlers, reaper e menu compartilham o estado
+        self.journal = None  # TrackerJournal quando o estado é persistido em disco
+        # Modo com vários processos: este processo guarda só os torrents do seu shard
+        self.shard_index = shard_index
+        self.shard_paths = shard_paths or []  # socket Unix interno de cada shard
+        self.shard_count = max(1, len(self.shard_paths))
+        self.router = ShardRouter(self) if self.shard_count > 1 else None
+        # Anúncios por UDP na mesma porta; o segredo assina os connection_id (igual em todos os shards)
+        self.udp = udp
+        self.udp_secret = udp_secret or os.urandom(16)
+        self.metrics = Metrics('minibt_tracker')
+        self._register_gauges()
+        if state_dir:
+            start = time.time()
+            self.journal = TrackerJournal(state_dir)
+            self.journal.restore(self)
+            log.info("Estado recarregado de %s: %d torrents, %d anúncios em %.2fs",
+                     state_dir, len(self.torrents), len(self.expiry), time.time() - start)
+    
+    def _register_gauges(self):
+        """Medidores lidos só quando alguém pede as métricas (sob self.lock)"""
+        metrics = self.metrics
+        metrics.gauge('shard', lambda: self.shard_index)
+        metrics.gauge('connections', lambda: metrics.value('connections_opened') -
+                      metrics.value('connections_closed'))
+        metrics.gauge('torrents', lambda: len(self.torrents))
+        metrics.gauge('peers', lambda: len(self.peers))
+        metrics.gauge('seeders', lambda: sum(len(data['seeders']) for data in self.torrents.values()))
+        metrics.gauge('leechers', lambda: sum(len(data['leechers']) for data in self.torrents.values()))
+        metrics.gauge('largest_swarm', lambda: max((len(data['seeders']) + len(data['leechers'])
+                                                    for data in self.torrents.values()), default=0))
+        metrics.gauge('expiry_entries', lambda: len(self.expiry))
+    
+    def _listen(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.shard_count > 1:
+            # Todos os shards escutam a mesma porta; o kernel distribui as conexões
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server.bind((self.host, self.port))
-        server.listen(5)
-        print(f"Tracker iniciado em {self.host}:{self.port}")
+        server.listen(self.backlog)
+        return server
+    
+    def _listen_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.shard_count > 1:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        return sock
+    
+    def shard_for(self, request):
+        """Shard que deve atender o pedido (None = este processo)"""
+        if self.shard_count == 1:
+            return None
+        action = request.get('action')
+        if action == 'list_torrents' and not request.get('local'):
+            return ALL_SHARDS
+        if action == 'announce_batch' and not request.get('local'):
+            owners = {shard_of(entry['torrent_hash'], self.shard_count) for entry in request['torrents']}
+            return None if owners <= {self.shard_index} else ALL_SHARDS
+        if action in ('announce', 'get_peers', 'register_torrent'):
+            owner = shard_of(request['torrent_hash'], self.shard_count)
+            if owner != self.shard_index:
+                return owner
+        return None
+        
+    def _start_maintenance(self):
+        """Threads de fundo: limpeza de peers expirados e gravação do log"""
+        def reap_forever():
+            while True:
+                time.sleep(REAP_INTERVAL)
+                with self.lock:
+                    self.reap_expired()
+        threading.Thread(target=reap_forever, daemon=True).start()
+        if self.journal:
+            threading.Thread(target=self.journal.run, args=(self,), daemon=True).start()
+    
+    def start(self):
+        """Modo com uma thread por conexão"""
+        server = self._listen()
+        self._start_maintenance()
+        if self.udp:
+            threading.Thread(target=self.serve_udp, args=(self._listen_udp(),), daemon=True).start()
+        log.info("Tracker iniciado em %s:%s", self.host, self.port)
         
         while True:
             client, addr = server.accept()
@@ -27,32 +591,154 @@ class Tracker:
             thread.daemon = True
             thread.start()
     
+    def start_async(self):
+        """Modo com laço de eventos: todas as conexões atendidas por uma única thread"""
+        server = self._listen()
+        server.setblocking(False)
+        self._start_maintenance()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(loop.create_server(lambda: TrackerProtocol(self), sock=server,
+                                                   backlog=self.backlog))
+        if self.udp:
+            loop.run_until_complete(loop.create_datagram_endpoint(lambda: TrackerDatagramProtocol(self),
+                                                                  sock=self._listen_udp()))
+        if self.shard_count > 1:
+            path = self.shard_paths[self.shard_index]
+            if os.path.exists(path):
+                os.remove(path)
+            loop.run_until_complete(loop.create_unix_server(lambda: TrackerProtocol(self), path))
+            log.info("Tracker (shard %d/%d) iniciado em %s:%s",
+                     self.shard_index + 1, self.shard_count, self.host, self.port)
+        else:
+            log.info("Tracker (assíncrono) iniciado em %s:%s", self.host, self.port)
+        loop.run_forever()
+    
     def handle_client(self, client, addr):
+        """Atende um cliente (quadros binários ou JSON legado) na sua própria thread"""
+        metrics = self.metrics
+        metrics.count('connections_opened')
         try:
-            print(f"\nNova conexão de {addr}")
-            data = client.recv(4096).decode('utf-8')
-            print(f"Dados recebidos: {data}")
-            request = json.loads(data)
-            response = self.process_request(request)
-            client.send(json.dumps(response).encode('utf-8'))
+            log.debug("Nova conexão de %s", addr)
+            client.settimeout(CLIENT_IDLE_TIMEOUT)
+            head = client.recv(len(MAGIC))
+            if head and MAGIC.startswith(head):
+                head += bytes(recv_exact(client, len(MAGIC) - len(head)))
+            if head == MAGIC:
+                # Conexão persistente: atende quadros em ordem até o cliente fechar
+                message = recv_frame(client, head, with_size=True)
+                while message is not None:
+                    request, _, size = message
+                    metrics.count('bytes_received', size, transport='tcp')
+                    log.debug("Pedido de %s: %s", addr, request)
+                    response, body = self.process_request(request)
+                    if 'id' in request:
+                        response['id'] = request['id']
+                    metrics.count('bytes_sent', send_frame(client, response, body), transport='tcp')
+                    message = recv_frame(client, with_size=True)
+                return
+            
+            message = recv_json(client, head, with_size=True)
+            if message is None:
+                return
+            request, size = message
+            metrics.count('bytes_received', size, transport='tcp')
+            log.debug("Pedido de %s: %s", addr, request)
+            request.pop('compact', None)  # a lista compacta só existe com quadros binários
+            response, _ = self.process_request(request)
+            data = json.dumps(response).encode('utf-8')
+            metrics.count('bytes_sent', len(data), transport='tcp')
+            client.sendall(data)
+        except socket.timeout:
+            pass
         except Exception as e:
-            print(f"Erro com {addr}: {str(e)}")
+            log.warning("Erro com %s: %s", addr, e)
         finally:
+            metrics.count('connections_closed')
             client.close()
     
+    def serve_udp(self, sock):
+        """Atende os anúncios UDP numa thread própria (modo com threads)"""
+        while True:
+            data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+            self.metrics.count('bytes_received', len(data), transport='udp')
+            try:
+                transaction_id, request, reply = self.parse_datagram(data, addr)
+                if request is not None:
+                    reply = self.udp_reply(transaction_id, request, *self.process_request(request))
+                self.metrics.count('bytes_sent', len(reply), transport='udp')
+                sock.sendto(reply, addr)
+            except Exception as e:
+                self.metrics.count('datagrams_dropped')
+                log.debug("Datagrama descartado de %s: %s", addr, e)
+    
+    def connection_id(self, addr, window=None):
+        """connection_id de `addr` numa janela de tempo: assinado com o segredo, sem tabela no servidor"""
+        if window is None:
+            window = int(time.time() // UDP_CONNECTION_WINDOW)
+        digest = hashlib.blake2b(f"{addr[0]}:{addr[1]}:{window}".encode('utf-8'),
+                                 key=self.udp_secret, digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+    
+    def parse_datagram(self, data, addr):
+        """Valida um datagrama UDP e retorna (transação, pedido, resposta pronta).
+
+        Connect e connection_id inválido já saem com a resposta pronta (pedido None);
+        datagramas malformados levantam ProtocolError e são descartados.
+        """
+        connection_id, action, transaction_id, fields = unpack_udp_request(data)
+        if action == UDP_CONNECT:
+            if connection_id != UDP_PROTOCOL_ID:
+                raise ProtocolError("connect sem o identificador do protocolo")
+            return transaction_id, None, (UDP_RESPONSE.pack(UDP_CONNECT, transaction_id) +
+                                          UDP_CONNECTION.pack(self.connection_id(addr)))
+        
+        window = int(time.time() // UDP_CONNECTION_WINDOW)
+        if connection_id not in (self.connection_id(addr, window), self.connection_id(addr, window - 1)):
+            # Endereço forjado ou id vencido: o cliente legítimo refaz o connect
+            return transaction_id, None, pack_udp_response(UDP_ERROR, transaction_id, {
+                'status': 'error', 'message': 'connection_id inválido', 'reconnect': True})
+        if action not in UDP_ACTIONS:
+            return transaction_id, None, pack_udp_response(UDP_ERROR, transaction_id, {
+                'status': 'error', 'message': 'Ação inválida'})
+        # Por UDP as listas de peers são sempre compactas (cabem num datagrama)
+        return transaction_id, dict(fields, action=UDP_ACTIONS[action], compact=True), None
+    
+    def udp_reply(self, transaction_id, request, response, body):
+        action = UDP_ACTION_CODES[request['action']] if response.get('status') == 'success' else UDP_ERROR
+        return pack_udp_response(action, transaction_id, response, body)
+    
     def process_request(self, request):
+        """Despacha um pedido e retorna (resposta, corpo binário)"""
+        start = time.perf_counter()
+        with self.lock:
+            response, body = self._dispatch(request)
+        # Ações desconhecidas viram um rótulo só: o cliente não cria séries novas à vontade
+        action = request.get('action')
+        if action not in ACTIONS:
+            action = 'invalid'
+        self.metrics.observe('request_seconds', time.perf_counter() - start, action=action)
+        if response.get('status') != 'success':
+            self.metrics.count('request_errors', action=action)
+        return response, body
+    
+    def _dispatch(self, request):
         action = request.get('action')
     
         if action == 'list_torrents':
-            return self.handle_list_torrents()
+            return self.handle_list_torrents(), b''
         elif action == 'announce':
             return self.handle_announce(request)
+        elif action == 'announce_batch':
+            return self.handle_announce_batch(request), b''
         elif action == 'get_peers':
             return self.handle_get_peers(request)
         elif action == 'register_torrent':
-            return self.handle_register_torrent(request)
+            return self.handle_register_torrent(request), b''
+        elif action == 'stats':
+            return self.handle_stats(request)
         else:
-            return {'status': 'error', 'message': 'Ação inválida'}
+            return {'status': 'error', 'message': 'Ação inválida'}, b''
             
     def handle_list_torrents(self):
         """Retorna lista simplificada de todos os torrents"""
@@ -62,10 +748,18 @@ class Tracker:
                 'hash': torrent_hash,
                 'name': data['file_info'].get('name', 'Unknown'),
                 'size': data['file_info'].get('size', 0),
-                'peers': len(data['peers'])
+                'peers': len(data['seeders']) + len(data['leechers']),
+                'seeders': len(data['seeders']),
+                'leechers': len(data['leechers'])
             })
         return {'status': 'success', 'torrents': torrent_list}
     
+    def handle_stats(self, request):
+        """Métricas do processo: JSON na resposta ou, com `format: text`, o formato do Prometheus no corpo"""
+        if request.get('format') == 'text':
+            return {'status': 'success', 'format': 'text'}, self.metrics.exposition().encode('utf-8')
+        return {'status': 'success', 'metrics': self.metrics.snapshot()}, b''
+    
     def handle_announce(self, request):
         peer_id = request['peer_id']
         torrent_hash = request['torrent_hash']
@@ -73,60 +767,194 @@ class Tracker:
         port = request['port']
         is_seeder = request.get('is_seeder', False)
     
-        # Atualiza ou registra o peer
-        self.peers[peer_id] = {
-            'host': host,
-            'port': port,
-            'last_seen': time.time(),
-            'is_seeder': is_seeder
-        }
-    
         # Verifica se o torrent existe
         if torrent_hash not in self.torrents:
-            return {'status': 'error', 'message': 'Torrent não registrado'}
-    
-        # Adiciona peer ao torrent (usando set para evitar duplicatas)
-        if is_seeder or torrent_hash in self.torrents:
-            self.torrents[torrent_hash]['peers'].add(peer_id)
-    
-        # Coleta informações dos peers (excluindo o próprio peer)
-        active_seeders = []
-        for pid in self.torrents[torrent_hash]['peers']:
-            peer_info = self.peers.get(pid)
-            if (peer_info and 
-                peer_info['is_seeder'] and 
-                time.time() - peer_info['last_seen'] < 1800):
-                active_seeders.append({
-                    'peer_id': pid,
-                    'host': peer_info['host'],
-                    'port': peer_info['port']
-                })
-
-        return {'status': 'success', 'peers': active_seeders}
+            return {'status': 'error', 'message': 'Torrent não registrado'}, b''
+    
+        now = time.time()
+        self._announce(torrent_hash, peer_id, host, port, is_seeder, now)
+        if self.journal:
+            self.journal.append(['A', torrent_hash, peer_id, host, port, is_seeder, now])
+    
+        # Leechers também entram na resposta: eles servem os pedaços que já baixaram
+        return self._peers_response(request, self.torrents[torrent_hash], peer_id)
+    
+    def handle_announce_batch(self, request):
+        """Anúncio de vários torrents de um mesmo peer (reanúncios periódicos, sem listas de peers)"""
+        peer_id = request['peer_id']
+        host = request['host']
+        port = request['port']
+        
+        now = time.time()
+        announced = 0
+        unknown = []
+        for entry in request['torrents']:
+            torrent_hash = entry['torrent_hash']
+            if torrent_hash not in self.torrents:
+                unknown.append(torrent_hash)
+                continue
+            is_seeder = entry.get('is_seeder', False)
+            self._announce(torrent_hash, peer_id, host, port, is_seeder, now)
+            if self.journal:
+                self.journal.append(['A', torrent_hash, peer_id, host, port, is_seeder, now])
+            announced += 1
+        return {'status': 'success', 'announced': announced, 'unknown': unknown}
+    
+    def _announce(self, torrent_hash, peer_id, host, port, is_seeder, now):
+        """Aplica um anúncio ao estado (usado pelos pedidos e pela recarga do log)"""
+        torrent = self.torrents[torrent_hash]
+        
+        # Atualiza ou registra o peer
+        peer = self.peers.setdefault(peer_id, {'torrents': set()})
+        if peer.get('host') != host:
+            peer.pop('ip', None)  # endereço empacotado é recalculado na próxima resposta compacta
+        peer.update(host=host, port=port, last_seen=now)
+        peer['torrents'].add(torrent_hash)
+    
+        # Seeders e leechers ficam em índices separados; quem completou o download muda de lado
+        if is_seeder:
+            torrent['leechers'].discard(peer_id)
+            torrent['seeders'].add(peer_id)
+        else:
+            torrent['seeders'].discard(peer_id)
+            torrent['leechers'].add(peer_id)
+        self.expiry.touch((torrent_hash, peer_id), now + PEER_TTL)
     
     def handle_get_peers(self, request):
         torrent_hash = request['torrent_hash']
         if torrent_hash in self.torrents:
-            peers = []
-            for pid in self.torrents[torrent_hash]['peers']:
-                if pid in self.peers:
-                    peer_info = self.peers[pid]
-                    peers.append({
-                        'peer_id': pid,
-                        'host': peer_info['host'],
-                        'port': peer_info['port']
-                    })
-            return {'status': 'success', 'peers': peers}
-        return {'status': 'error', 'message': 'Torrent não encontrado'}
+            return self._peers_response(request, self.torrents[torrent_hash])
+        return {'status': 'error', 'message': 'Torrent não encontrado'}, b''
+    
+    def _numwant(self, request):
+        return max(0, min(int(request.get('numwant', DEFAULT_NUMWANT)), MAX_NUMWANT))
+    
+    def _peers_response(self, request, torrent, exclude=None):
+        """Resposta com a amostra de peers: lista JSON ou, com `compact`, registros binários no corpo"""
+        sample = self._sample_peer_ids(torrent, self._numwant(request), exclude)
+        if request.get('compact'):
+            addresses = []
+            for peer_id, _ in sample:
+                peer_info = self.peers[peer_id]
+                if 'ip' not in peer_info:
+                    # Empacotado uma vez por host e guardado para as próximas respostas
+                    peer_info['ip'] = pack_host(peer_info['host'])
+                if peer_info['ip'] is not None:
+                    addresses.append((peer_info['ip'], peer_info['port']))
+            count4, count6, body = pack_peers(addresses)
+            return {'status': 'success', 'peers4': count4, 'peers6': count6}, body
+        return {'status': 'success', 'peers': self._peer_dicts(sample)}, b''
+    
+    def _sample_peer_ids(self, torrent, numwant, exclude=None):
+        """Sorteia até `numwant` (peer_id, is_seeder) do torrent em O(numwant), sem percorrer o enxame"""
+        seeders, leechers = torrent['seeders'], torrent['leechers']
+        total = len(seeders) + len(leechers)
+        # Sorteia um a mais para poder descartar o próprio peer
+        picks = random.sample(range(total), min(total, numwant + 1))
+        
+        sample = []
+        for position in picks:
+            if position < len(seeders):
+                peer_id, is_seeder = seeders.items[position], True
+            else:
+                peer_id, is_seeder = leechers.items[position - len(seeders)], False
+            if peer_id != exclude:
+                sample.append((peer_id, is_seeder))
+        return sample[:numwant]
+    
+    def _peer_dicts(self, sample):
+        peers = []
+        for peer_id, is_seeder in sample:
+            peer_info = self.peers[peer_id]
+            peers.append({
+                'peer_id': peer_id,
+                'host': peer_info['host'],
+                'port': peer_info['port'],
+                'is_seeder': is_seeder
+            })
+        return peers
+    
+    def reap_expired(self, now=None):
+        """Remove dos torrents os peers que pararam de anunciar há mais de PEER_TTL"""
+        expired = self.expiry.expire(now or time.time())
+        for torrent_hash, peer_id in expired:
+            self._remove_peer(torrent_hash, peer_id)
+        return len(expired)
+    
+    def _remove_peer(self, torrent_hash, peer_id):
+        torrent = self.torrents.get(torrent_hash)
+        if torrent:
+            torrent['seeders'].discard(peer_id)
+            torrent['leechers'].discard(peer_id)
+        peer = self.peers.get(peer_id)
+        if peer:
+            peer['torrents'].discard(torrent_hash)
+            if not peer['torrents']:
+                del self.peers[peer_id]
     
     def handle_register_torrent(self, request):
         torrent_hash = request['torrent_hash']
         file_info = request['file_info']
         
         if torrent_hash not in self.torrents:
-            self.torrents[torrent_hash] = {'peers': set(), 'file_info': file_info}
+            self._register(torrent_hash, file_info)
+            if self.journal:
+                self.journal.append(['R', torrent_hash, file_info])
         
         return {'status': 'success', 'message': 'Torrent registrado'}
+    
+    def _register(self, torrent_hash, file_info):
+        if torrent_hash not in self.torrents:
+            self.torrents[torrent_hash] = {'seeders': PeerSet(), 'leechers': PeerSet(), 'file_info': file_info}
+    
+    def _copy_state(self):
+        """Cópia rasa do estado vivo (sob self.lock): só cópias de listas e dicionários, feitas em C"""
+        torrents = {torrent_hash: (data['file_info'], data['seeders'].items[:], data['leechers'].items[:])
+                    for torrent_hash, data in self.torrents.items()}
+        return torrents, self.peers.copy()
+    
+    def _export_state(self, copy, log_seq):
+        """Texto JSON da snapshot, em pedaços, a partir de uma cópia de `_copy_state` (fora do lock).
+
+        Cada pedaço é uma chamada curta ao codificador em C, então as threads dos pedidos
+        voltam a rodar entre eles. Os dicionários dos peers continuam compartilhados: um
+        anúncio posterior pode adiantar o `last_seen` lido aqui, o que a reaplicação do
+        log novo também faria.
+        """
+        torrents, peers = copy
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+        yield f'{{"log_seq":{log_seq},"torrents":{{'
+        separator = ''
+        for torrent_hash, (file_info, seeders, leechers) in torrents.items():
+            yield separator + encode(torrent_hash) + ':' + encode(
+                {'file_info': file_info, 'seeders': seeders, 'leechers': leechers})
+            separator = ','
+        yield '},"peers":{'
+        items = iter(peers.items())
+        separator = ''
+        while True:
+            batch = {peer_id: [peer['host'], peer['port'], peer['last_seen']]
+                     for peer_id, peer in islice(items, SNAPSHOT_CHUNK)}
+            if not batch:
+                break
+            yield separator + encode(batch)[1:-1]
+            separator = ','
+        yield '}}'
+    
+    def _import_state(self, state):
+        """Recarrega em lote o que `_export_state` gravou, sem passar anúncio por anúncio"""
+        for peer_id, (host, port, last_seen) in state['peers'].items():
+            self.peers[peer_id] = {'host': host, 'port': port, 'last_seen': last_seen, 'torrents': set()}
+        
+        for torrent_hash, data in state['torrents'].items():
+            self.torrents[torrent_hash] = {'seeders': PeerSet(data['seeders']),
+                                           'leechers': PeerSet(data['leechers']),
+                                           'file_info': data['file_info']}
+            members = data['seeders'] + data['leechers']
+            for peer_id in members:
+                self.peers[peer_id]['torrents'].add(torrent_hash)
+            self.expiry.load(((torrent_hash, peer_id), self.peers[peer_id]['last_seen'] + PEER_TTL)
+                             for peer_id in members)
         
     def interactive_menu(self):
         """Menu interativo para o tracker"""
@@ -145,42 +973,34 @@ class Tracker:
                     print("Nenhum torrent registrado.")
                     continue
                 
-                for torrent_hash, data in self.torrents.items():
-                    print(f"\nHash: {torrent_hash}")
-                    print(f"Arquivo: {data['file_info'].get('name', 'N/A')}")
-                    print(f"Tamanho: {data['file_info'].get('size', 0)} bytes")
-                
-                    if not data['peers']:
-                        print("Peers: Nenhum peer ativo")
-                        continue
+                with self.lock:
+                    for torrent_hash, data in self.torrents.items():
+                        print(f"\nHash: {torrent_hash}")
+                        print(f"Arquivo: {data['file_info'].get('name', 'N/A')}")
+                        print(f"Tamanho: {data['file_info'].get('size', 0)} bytes")
                     
-                    print("Peers ativos:")
-                    active_peers = 0
-                
-                    for peer_id in list(data['peers']):  # Usamos list() para criar uma cópia
-                        peer = self.peers.get(peer_id)
-                    
-                        # Verifica se o peer existe e está ativo (últimos 30 minutos)
-                        if peer and time.time() - peer['last_seen'] < 1800:
-                            active_peers += 1
-                            print(f"  - {peer_id} ({peer['host']}:{peer['port']})")
-                        else:
-                            # Remove peer inativo
-                            data['peers'].discard(peer_id)
-                            if peer_id in self.peers:
-                                del self.peers[peer_id]
-                
-                    if active_peers == 0:
-                        print("  Nenhum peer ativo no momento")
+                        # Peers inativos já foram removidos pelo reaper
+                        if not data['seeders'] and not data['leechers']:
+                            print("Peers: Nenhum peer ativo")
+                            continue
+                        
+                        print(f"Peers ativos: {len(data['seeders'])} seeders, {len(data['leechers'])} leechers")
+                        for peer in self._peer_dicts(self._sample_peer_ids(data, 20)):
+                            role = 'seeder' if peer['is_seeder'] else 'leecher'
+                            print(f"  - {peer['peer_id']} ({peer['host']}:{peer['port']}, {role})")
         
             elif cmd == "stats":
                 print(f"\nEstatísticas do Tracker:")
                 print(f"- Torrents registrados: {len(self.torrents)}")
-                print(f"- Peers conhecidos: {len(self.peers)}")
-                print(f"- Peers ativos: {sum(1 for p in self.peers.values() if time.time() - p['last_seen'] < 1800)}")
+                print(f"- Peers ativos: {len(self.peers)}")
+                print(f"- Entradas aguardando expiração: {len(self.expiry)}")
+                with self.lock:
+                    print(self.metrics.exposition())
         
             elif cmd == "exit":
                 print("Encerrando tracker...")
+                if self.journal:
+                    self.journal.flush()
                 os._exit(0)
         
             else:
@@ -188,9 +1008,57 @@ class Tracker:
             
     
 
+def _run_shard(host, port, backlog, state_dir, shard_index, shard_paths, udp, udp_secret, log_level):
+    configure_logging(log_level)
+    shard_dir = os.path.join(state_dir, f"shard{shard_index}") if state_dir else None
+    Tracker(host, port, backlog, shard_dir, shard_index, shard_paths, udp, udp_secret).start_async()
+
+
+def run_sharded(host='localhost', port=8000, workers=None, backlog=1024, state_dir=None, udp=True,
+                log_level='INFO'):
+    """Sobe `workers` processos de tracker na mesma porta, dividindo os torrents pelo info-hash"""
+    workers = workers or os.cpu_count()
+    shard_paths = [os.path.join(tempfile.gettempdir(), f"tracker-{port}-shard{index}.sock")
+                   for index in range(workers)]
+    # O kernel pode entregar o connect e o announce UDP a shards diferentes: o segredo é comum
+    udp_secret = os.urandom(16)
+    processes = [multiprocessing.Process(target=_run_shard, daemon=True,
+                                         args=(host, port, backlog, state_dir, index, shard_paths,
+                                               udp, udp_secret, log_level))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
 if __name__ == "__main__":
-    tracker = Tracker()
+    parser = argparse.ArgumentParser(description="Tracker do MiniBitTorrent")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--backlog', type=int, default=1024, help='Fila de conexões pendentes do listen()')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Atende as conexões num laço de eventos em vez de uma thread por conexão')
+    parser.add_argument('--state-dir', default=None,
+                        help='Diretório do log e das snapshots (sem ele o estado fica só em memória)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processos do tracker (mais de um divide os torrents entre shards; usa SO_REUSEPORT)')
+    parser.add_argument('--no-udp', dest='udp', action='store_false',
+                        help='Não atende anúncios por UDP (só TCP)')
+    parser.add_argument('--log-level', default='INFO',
+                        help='Nível dos logs (DEBUG mostra cada conexão e pedido; custa caro sob carga)')
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    if args.workers > 1:
+        run_sharded(args.host, args.port, args.workers, args.backlog, args.state_dir, args.udp, args.log_level)
+        raise SystemExit
+
+    tracker = Tracker(args.host, args.port, args.backlog, args.state_dir, udp=args.udp)
     # Inicia o menu diferente do servidor
     threading.Thread(target=tracker.interactive_menu, daemon=True).start()
     #servidor
-    tracker.start() 
+    if args.use_async:
+        tracker.start_async()
+    else:
+        tracker.start() 